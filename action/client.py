@@ -22,41 +22,137 @@
 
 import os
 import json
+import base64
 
 from messenger import rabbitmq
 
+#Pools are kept across warm activations of the action container, keyed by
+#RabbitContext, so a publisher is reused if its connection is still healthy
+POOLS = {}
+
+#Number of published replies that may be awaiting confirmation from the broker
+CONFIRM_WINDOW = 100
+
+
+def new_publisher(context):
+    """
+        Connects a client for publishing replies, which waits for the broker to confirm them
+
+        Throws:
+            An exception if the connection is not successful
+
+        Returns:
+            A RabbitClient
+    """
+    #Don't hold up the activation retrying a broken connection for long
+    client = rabbitmq.RabbitClient(context, connection_attempts=3, retry_delay=1)
+    client.confirm_delivery(window=CONFIRM_WINDOW)
+    return client
 
-def main(args):
-    activation = os.getenv('__OW_ACTIVATION_ID', None)
 
+def get_publisher(context, publish_queue):
+    """
+        Checks out a connected client for the RabbitMQ service, reusing the client
+        from an earlier activation if its connection is still healthy
+
+        Throws:
+            An exception if a new connection is not successful
+
+        Returns:
+            A RabbitClient, with publish_queue as its default queue
+    """
+    pool = POOLS.get(context)
+    if pool is None:
+        pool = rabbitmq.RabbitPool(context, max_connections=1, factory=new_publisher)
+        POOLS[context] = pool
+
+    client = pool.checkout()
+
+    queue = rabbitmq.RabbitQueue(publish_queue)
     try:
-        messages = 0
+        if queue.name in client.declared:
+            client.queue = queue
+        else:
+            client.start_queue(queue=queue)
+    except Exception:
+        pool.checkin(client, discard=True)
+        raise
+
+    return client
+
 
-        cfg = ['broker_host', 'broker_vhost', 'broker_port',
-               'broker_user', 'broker_password', 'publish_queue']
-        for key in cfg:
-            if args.get(key) is None:
-                raise Exception('{} is missing'.format(key))
+def publish(args, replies):
+    """
+        Publishes the replies to the publish_queue of the RabbitMQ service
 
-        host = args['broker_host']
-        vhost = args['broker_vhost']
-        port = args['broker_port']
-        user = args['broker_user']
-        password = args['broker_password']
-        publish_queue = args['publish_queue']
+        Throws:
+            An exception if a setting is missing, or the replies cannot be published
 
-        context = rabbitmq.RabbitContext(host, port, user, password, vhost)
+        Returns:
+            None
+    """
+    cfg = ['broker_host', 'broker_vhost', 'broker_port',
+           'broker_user', 'broker_password', 'publish_queue']
+    for key in cfg:
+        if args.get(key) is None:
+            raise Exception('{} is missing'.format(key))
+
+    host = args['broker_host']
+    vhost = args['broker_vhost']
+    port = args['broker_port']
+    user = args['broker_user']
+    password = args['broker_password']
+    publish_queue = args['publish_queue']
+
+    context = rabbitmq.RabbitContext(host, port, user, password, vhost)
+
+    if not replies:
+        return
+
+    client = get_publisher(context, publish_queue)
+    #Large replies are compressed, if a content encoding is given
+    client.compression = args.get('compression')
+    failed = True
+
+    try:
+        failures = client.publish_many(json.dumps(reply) for reply in replies)
+        if failures:
+            raise failures[0][1]
+
+        #Only report success once the broker has accepted every reply
+        nacked = client.wait_for_confirms()
+        if nacked:
+            raise Exception('{} messages rejected by the broker'.format(len(nacked)))
+        failed = False
+    finally:
+        #The connection may be broken after a failure, so start afresh next time
+        POOLS[context].checkin(client, discard=failed)
+
+
+def main(args):
+    activation = os.getenv('__OW_ACTIVATION_ID', None)
+
+    try:
+        messages = 0
 
-        if 'messages' in args:
-            with rabbitmq.RabbitClient(context) as client:
-                client.start_queue(queue=rabbitmq.RabbitQueue(publish_queue))
+        if 'encoding' in args:
+            #The listener compressed the messages, see WHISK_ENCODING
+            data = rabbitmq.decompress(base64.b64decode(args['data']), args['encoding'])
+            args = dict(args)
+            args.update(json.loads(str(data, 'utf-8')))
 
-                for msg in args['messages']:
-                    messages += 1
-                    print(msg)
-                    client.publish(json.dumps({'count' : messages}))
+        replies = []
+        for msg in args.get('messages', []):
+            messages += 1
+            print(msg)
+            replies.append({'count' : messages})
 
-        result = {'messages': messages}
+        if args.get('rpc') is True:
+            #The listener publishes the replies, see WHISK_RPC
+            result = {'messages': messages, 'replies': replies}
+        else:
+            publish(args, replies)
+            result = {'messages': messages}
     except Exception as err:
         result = {'result': str(err)}
         print("Error: %r" % err)
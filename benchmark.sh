@@ -0,0 +1,9 @@
+#!/bin/bash
+#Author: Mark Purcell (markpurcell@ie.ibm.com)
+
+#Run the offline listener benchmark, no RabbitMQ service or Cloud Functions needed
+#For example: ./benchmark.sh --sizes 100,100000 --prefetch 1,32 --output bench.jsonl
+cd invoker
+ln -s ../messenger
+python3 benchmark.py "$@"
+rm messenger
@@ -17,5 +17,6 @@ export WHISK_ACTION='RabbitFeedEndpoint'
 export WHISK_SPACE=                       #Your Openwhisk namespace
 export WHISK_AUTH=''                      #Your Openwhisk auth key
 export WHISK_URL=''                       #Your Openwhisk URL
+export WHISK_RPC=false                    #true for the listener to publish the action results as replies
 
 
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Asyncio based RabbitMQ queue listener and Cloud Function invoker.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import json
+import signal
+import asyncio
+import logging
+
+import aiohttp
+import aio_pika
+
+from messenger import rabbitmq
+
+import throttle
+import payload
+import logs
+
+LOGGER = logging.getLogger(__package__)
+
+MAX_PAYLOAD = payload.MAX_PAYLOAD
+
+#Invocation responses, logged one by one unless summarised, see LOG_SUMMARY
+RESPONSES = logs.Summary('Responses', ('invocations', 'messages', 'retries', 'failed'))
+
+
+class AsyncWhiskInvoker:
+    """AsyncWhiskInvoker"""
+    def __init__(self, context, session, blocking='false', result='false'):
+        self.context = context
+        self.session = session
+        self.params = {'blocking': blocking, 'result': result}
+
+    async def invoke(self, json_msg, action):
+        """
+            Invokes an Openwhisk action, catching all exceptions
+
+            Throws:
+                No exception thrown
+
+            Returns:
+                The response from Openwhisk, or a dict containing an error
+        """
+
+        try:
+            async with self.session.post(self.context.url + action, data=json_msg, params=self.params) as response:
+                status = response.status
+                text = await response.text()
+        except Exception as expt:
+            #Something went wrong - could be a general error
+            #or under high load, too many in-flight activations
+            #Retry policy is the responsibility of the caller
+            return {'error': str(expt)}
+
+        # It's possible that the OW action is not available
+        # in which case there will be an "error" entry in the response dict
+        try:
+            return json.loads(text)
+        except ValueError:
+            #A gateway in front of Openwhisk may answer with an HTML page, as whisk.post
+            return {'error': 'HTTP {0}: {1}'.format(status, text[:200]), 'code': None}
+
+
+class AsyncMessageHandler:
+    """handle relay from rabbitmq to openwhisk, for many messages at once"""
+    def __init__(self, invoker, action, whisk_retries, concurrency):
+        self.invoker = invoker
+        self.action = action
+        self.whisk_retries = whisk_retries
+        self.inflight = asyncio.Semaphore(concurrency)
+        self.shutting_down = False
+
+    async def send_to_whisk(self, recv_msg):
+        """
+            Attempt to invoke an action with the message body as a parameter to the action
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                True if the message was handled, otherwise False
+        """
+
+        retry = 0
+        recv_msg_size = 0
+        result = None
+        handled = False
+
+        try:
+            recv_msg_size = len(recv_msg)
+            json_msg = payload.build([recv_msg])
+            if len(json_msg) > MAX_PAYLOAD:
+                #Need to ensure we dont send to much data whilst invoking the action
+                raise BufferError("Message payload too large; {0} > {1} bytes!".format(len(json_msg), MAX_PAYLOAD))
+
+            #Its possible to have too many inflight whisk activations
+            #So we'll need to retry if this error occurs
+
+            while retry < self.whisk_retries and not self.shutting_down:
+                #Only hold an invocation slot whilst invoking, not whilst backing off
+                async with self.inflight:
+                    result = await self.invoker.invoke(json_msg, self.action)
+                if 'error' not in result:
+                    handled = True
+                    break
+
+                await asyncio.sleep(throttle.backoff(retry))
+                retry += 1
+
+            RESPONSES.add(self.action, 1, 1, retry, 0 if handled else 1)
+            #Failures are always logged in full
+            if not handled:
+                LOGGER.warning("Response: %r:%r retries...%r", self.action, retry, result)
+            elif RESPONSES.sampled():
+                LOGGER.info("Response: %r:%r retries...%r", self.action, retry, result)
+        except Exception as expt:
+            LOGGER.error("Message Error: %r", expt)
+            LOGGER.error("Received: %d bytes", recv_msg_size)
+            LOGGER.error("Received: %s", recv_msg[:1000])
+
+        return handled
+
+    async def handle(self, message):
+        """
+            Consumer callback, acks the message if the action was invoked,
+            rejects it if its body cannot be decompressed, otherwise returns
+            it to the queue
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        try:
+            try:
+                body = rabbitmq.decode(message.body, message.content_encoding)
+            except Exception as expt:
+                #A body that cannot be decompressed never will be
+                LOGGER.error("Decode Exception: %r", expt)
+                await message.reject(requeue=False)
+                return
+
+            handled = await self.send_to_whisk(body)
+
+            if handled:
+                await message.ack()
+            else:
+                await message.nack(requeue=True)
+        except Exception as expt:
+            #The channel has gone, the broker will redeliver the message
+            LOGGER.error("Handler Exception: %r", expt)
+
+
+async def consume(rabbit_context, subscribe, prefetch, handler):
+    """
+        Opens a robust (self reconnecting) connection to RabbitMQ and starts consuming
+
+        Throws:
+            An exception if the first connection attempt is not successful
+
+        Returns:
+            The connection
+    """
+    ssl_options = {}
+    if rabbit_context.cert is not None:
+        ssl_options['cafile'] = rabbit_context.cert
+
+    connection = await aio_pika.connect_robust(
+        host=rabbit_context.host, port=rabbit_context.port,
+        login=rabbit_context.user, password=rabbit_context.pwd,
+        virtualhost=rabbit_context.vhost, ssl=rabbit_context.ssl,
+        ssl_options=ssl_options)
+
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=prefetch)
+
+    queue = await channel.declare_queue(subscribe, auto_delete=False, durable=False)
+    await queue.consume(handler.handle)
+
+    LOGGER.info("Waiting on %r...", subscribe)
+    return connection
+
+
+async def serve(whisk_context, rabbit_context, subscribe, whisk_retries, action,
+                num_connections, prefetch, concurrency):
+    """
+        Relays messages from RabbitMQ to Openwhisk until interrupted by a signal
+
+        Throws:
+            An exception if a connection cannot be established
+
+        Returns:
+            Nothing
+    """
+    loop = asyncio.get_event_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    #A single HTTP connection pool is shared by every consumer
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    auth = aiohttp.BasicAuth(whisk_context.user_pass[0], whisk_context.user_pass[1])
+
+    async with aiohttp.ClientSession(
+            connector=connector, auth=auth,
+            headers={'content-type': 'application/json'}) as session:
+
+        handler = AsyncMessageHandler(AsyncWhiskInvoker(whisk_context, session), action, whisk_retries, concurrency)
+
+        LOGGER.info("Connecting to RabbitMQ...")
+        connections = await asyncio.gather(*[
+            consume(rabbit_context, subscribe, prefetch, handler)
+            for _ in range(0, num_connections)])
+
+        await stopping.wait()
+
+        LOGGER.info("Stopping...")
+        handler.shutting_down = True
+        for connection in connections:
+            await connection.close()
+
+
+def run(whisk_context, rabbit_context, subscribe, whisk_retries, action,
+        num_connections, prefetch, concurrency):
+    """
+        Runs the asyncio engine, each connection consumes up to prefetch messages
+        and at most concurrency actions are invoked at once across all connections
+
+        Throws:
+            An exception if a connection cannot be established
+
+        Returns:
+            Nothing
+    """
+    #Make sure the broker delivers enough messages to keep every invocation busy
+    prefetch = max(prefetch, -(-concurrency // num_connections))
+
+    LOGGER.info("Asyncio engine, %d connections, %d prefetch, %d concurrent invocations.",
+                num_connections, prefetch, concurrency)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve(
+            whisk_context, rabbit_context, subscribe, whisk_retries, action,
+            num_connections, prefetch, concurrency))
+    finally:
+        loop.close()
+        LOGGER.info("Stopped.")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Queue depth driven scaling of the number of listener consumers.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import time
+import logging
+import functools
+
+from messenger import rabbitmq
+
+LOGGER = logging.getLogger(__package__)
+
+
+class QueueDepthProbe():
+    """
+        Counts the messages ready in a queue with a passive declare, over a
+        connection of its own that is reopened if it fails
+    """
+    def __init__(self, rabbit_context, queue, client_factory=None):
+        self.rabbit_context = rabbit_context
+        self.queue = queue
+        self.client_factory = client_factory or functools.partial(rabbitmq.RabbitClient, connection_attempts=1)
+        self.client = None
+
+    def __call__(self):
+        """
+            Samples the queue depth
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                The number of messages ready, or None if it could not be counted
+        """
+        try:
+            if self.client is None or not self.client.is_open():
+                self.close()
+                self.client = self.client_factory(self.rabbit_context)
+            return self.client.depth(self.queue)[0]
+        except Exception as expt:
+            LOGGER.error("Queue depth: %r", expt)
+            self.close()
+            return None
+
+    def close(self):
+        """Closes the connection of the probe"""
+        if self.client is not None:
+            self.client.stop()
+            self.client = None
+
+
+class Autoscaler():
+    """
+        Decides how many consumers there should be, from samples of the queue depth
+        (from the probe), the number of messages handled so far (from completed)
+        and how busy the consumers are (from utilization, 0 to 1).
+
+        A consumer is added, or half as many again, when the backlog would take
+        more than target seconds to clear at the current rate and the consumers
+        are at least high busy, for up_samples samples in a row. One is removed
+        when the backlog would clear within target seconds and the consumers are
+        less than low busy, for down_samples samples in a row. Between the two
+        the number is left alone, so it does not flap
+    """
+    def __init__(self, probe, completed, utilization, minimum=1, maximum=32, target=30.0,
+                 high=0.75, low=0.25, up_samples=2, down_samples=6):
+        self.probe = probe
+        self.completed = completed
+        self.utilization = utilization
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.target = target
+        self.high = high
+        self.low = low
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.ups = 0
+        self.downs = 0
+        self.last_completed = completed()
+        self.last_sample = time.monotonic()
+        #The last sample, for metrics
+        self.depth = None
+        self.rate = 0.0
+
+    def sample(self, active):
+        """
+            Samples the load on the active consumers
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                The number of consumers there should be
+        """
+        now = time.monotonic()
+        completed = self.completed()
+        self.rate = (completed - self.last_completed) / max(now - self.last_sample, 0.001)
+        self.last_completed = completed
+        self.last_sample = now
+
+        self.depth = self.probe()
+        if self.depth is None:
+            #Nothing to go on
+            self.ups = self.downs = 0
+            return max(min(active, self.maximum), self.minimum)
+
+        busy = self.utilization()
+        backlog = self.depth > max(self.rate, 1.0) * self.target
+        if backlog and busy >= self.high and active < self.maximum:
+            self.ups += 1
+            self.downs = 0
+        elif not backlog and busy < self.low and active > self.minimum:
+            self.downs += 1
+            self.ups = 0
+        else:
+            self.ups = self.downs = 0
+
+        wanted = active
+        if self.ups >= self.up_samples:
+            wanted = active + max(active // 2, 1)
+            self.ups = 0
+        elif self.downs >= self.down_samples:
+            wanted = active - 1
+            self.downs = 0
+
+        wanted = max(min(wanted, self.maximum), self.minimum)
+        if wanted != active:
+            LOGGER.info("Scaling consumers from %d to %d, depth: %r, rate: %.1f/s, utilization: %.2f",
+                        active, wanted, self.depth, self.rate, busy)
+        return wanted
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Offline listener throughput benchmark.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import itertools
+import threading
+import collections
+import multiprocessing
+import urllib.request
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import pika
+
+from messenger import rabbitmq
+
+import server
+import whisk
+
+LOGGER = logging.getLogger(__package__)
+
+
+class MemoryBroker:
+    """A single in-memory queue, standing in for a RabbitMQ service"""
+    def __init__(self):
+        self.messages = collections.deque()
+        self.condition = threading.Condition()
+
+    def publish(self, body, properties=None, redelivered=False):
+        """Adds a message to the back of the queue"""
+        with self.condition:
+            self.messages.append((body, properties or pika.BasicProperties(), redelivered))
+            self.condition.notify_all()
+
+    def requeue(self, message):
+        """Returns an unacknowledged message to the front of the queue"""
+        body, properties, _ = message
+        with self.condition:
+            self.messages.appendleft((body, properties, True))
+            self.condition.notify_all()
+
+
+class MemoryConnection:
+    """Stands in for a pika BlockingConnection to a MemoryBroker"""
+    def __init__(self, broker):
+        self.broker = broker
+        self.callbacks = collections.deque()
+        self.is_open = True
+
+    def channel(self):
+        return MemoryChannel(self)
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise Exception("Connection closed")
+        with self.broker.condition:
+            self.callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def run_callbacks(self):
+        """Runs callbacks added by other threads, on the calling thread"""
+        while True:
+            with self.broker.condition:
+                if not self.callbacks:
+                    return
+                callback = self.callbacks.popleft()
+            callback()
+
+    def process_data_events(self, time_limit=0):
+        with self.broker.condition:
+            if not self.callbacks and time_limit:
+                self.broker.condition.wait(time_limit)
+        self.run_callbacks()
+
+    def close(self):
+        self.is_open = False
+
+
+class MemoryChannel:
+    """Stands in for a pika BlockingChannel, honouring prefetch and acks"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch = 0
+        self.unacked = collections.OrderedDict()
+        self.delivery_tag = 0
+        self.cancelled = False
+        self.is_open = True
+
+    def queue_declare(self, queue, **kwargs):
+        pass
+
+    def queue_purge(self, queue):
+        with self.broker.condition:
+            self.broker.messages.clear()
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch = prefetch_count
+
+    def next_message(self):
+        """The next message, if the prefetch window allows, must hold the broker condition"""
+        if not self.broker.messages:
+            return None
+        if self.prefetch and len(self.unacked) >= self.prefetch:
+            return None
+
+        message = self.broker.messages.popleft()
+        self.delivery_tag += 1
+        self.unacked[self.delivery_tag] = message
+        body, properties, redelivered = message
+        return (pika.spec.Basic.Deliver(delivery_tag=self.delivery_tag, redelivered=redelivered), properties, body)
+
+    def consume(self, queue, exclusive=False, inactivity_timeout=None):
+        deadline = time.monotonic() + (inactivity_timeout or 3600)
+        while not self.cancelled:
+            self.connection.run_callbacks()
+
+            with self.broker.condition:
+                delivery = self.next_message()
+                if delivery is None and not self.callbacks_pending():
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        self.broker.condition.wait(remaining)
+                        continue
+
+            if delivery is not None or time.monotonic() >= deadline:
+                deadline = time.monotonic() + (inactivity_timeout or 3600)
+                yield delivery or (None, None, None)
+
+    def callbacks_pending(self):
+        return bool(self.connection.callbacks) or self.cancelled
+
+    def settle(self, delivery_tag, multiple):
+        """Removes acknowledged messages from the window"""
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        return [self.unacked.pop(tag) for tag in tags if tag in self.unacked]
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        for message in reversed(self.settle(delivery_tag, multiple)):
+            if requeue:
+                self.broker.requeue(message)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def cancel(self):
+        with self.broker.condition:
+            self.cancelled = True
+            self.broker.condition.notify_all()
+
+    def close(self):
+        #As with a real broker, unacknowledged messages are redelivered
+        for message in reversed(list(self.unacked.values())):
+            self.broker.requeue(message)
+        self.unacked.clear()
+        self.is_open = False
+
+
+class MemoryClient(rabbitmq.RabbitClient):
+    """A RabbitClient connected to a MemoryBroker rather than a RabbitMQ service"""
+    def __init__(self, context, broker):
+        self.broker = broker
+        super(MemoryClient, self).__init__(context)
+
+    def connect(self, connection_attempts, retry_delay):
+        self.connection = MemoryConnection(self.broker)
+        self.channel = self.connection.channel()
+
+
+class ActionRequestHandler(BaseHTTPRequestHandler):
+    """Stands in for the Cloud Functions action invocation API"""
+    protocol_version = 'HTTP/1.1'
+    #Headers and body are written separately, so avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def reply(self, status, result):
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        stats = self.server.stats
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        with self.server.lock:
+            self.server.inflight += 1
+            throttled = 0 < self.server.limit < self.server.inflight
+            stats['invocations'] += 1
+            if throttled:
+                stats['throttled'] += 1
+
+        try:
+            if throttled:
+                self.reply(429, {'error': 'Too many concurrent requests in flight (allowed: {0}).'.format(self.server.limit)})
+                return
+
+            time.sleep(self.server.latency)
+
+            now = time.time()
+            messages = json.loads(body.decode())['messages']
+            latencies = [now - (json.loads(msg) if isinstance(msg, str) else msg)['sent'] for msg in messages]
+            with self.server.lock:
+                stats['latencies'].extend(latencies)
+                stats['count'] += len(latencies)
+
+            self.reply(202, {'activationId': uuid.uuid4().hex})
+        finally:
+            with self.server.lock:
+                self.server.inflight -= 1
+
+    def do_HEAD(self):
+        #Opening a connection ahead of the first invocation
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.reply(200, self.server.stats)
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.stats = new_stats()
+            self.reply(200, {})
+
+    def log_message(self, *args):
+        pass
+
+
+class ActionServer(ThreadingMixIn, HTTPServer):
+    """ActionServer"""
+    daemon_threads = True
+    #Listeners open their connections all at once
+    request_queue_size = 128
+
+
+def new_stats():
+    return {'count': 0, 'invocations': 0, 'throttled': 0, 'latencies': []}
+
+
+def serve_action(ports, latency, limit):
+    """
+        Runs the stand in action endpoint, in its own process so that it does not
+        count towards the CPU time of the listener
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            Nothing
+    """
+    action_server = ActionServer(('127.0.0.1', 0), ActionRequestHandler)
+    action_server.lock = threading.Lock()
+    action_server.stats = new_stats()
+    action_server.inflight = 0
+    action_server.latency = latency
+    action_server.limit = limit
+    ports.put(action_server.server_address[1])
+    action_server.serve_forever()
+
+
+def request(url, method='GET'):
+    with urllib.request.urlopen(urllib.request.Request(url, method=method)) as response:
+        return json.loads(response.read().decode())
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def run_case(whisk_context, stats_url, args, size, connections, prefetch, batch):
+    """
+        Relays args.messages messages of size bytes through the listener
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            A dict of results
+    """
+    broker = MemoryBroker()
+    rabbit_context = rabbitmq.RabbitContext('memory', 0, 'bench', 'bench', '/', ssl=False)
+    padding = 'x' * size
+
+    def publish():
+        interval = 1.0 / args.rate if args.rate else 0
+        for _ in range(0, args.messages):
+            broker.publish(json.dumps({'sent': time.time(), 'pad': padding}).encode())
+            if interval:
+                time.sleep(interval)
+
+    request(stats_url, 'DELETE')
+    server.SHUTTING_DOWN = False
+
+    #With no publish rate, measure draining a full queue
+    if not args.rate:
+        publish()
+
+    limiter = server.throttle.AdaptiveLimiter(connections * max(prefetch, 1))
+    handlers = []
+    for index in range(0, connections):
+        handler = server.MessageHandlerThread(
+            whisk_context, rabbit_context, 'bench', 5, args.retries, 'bench',
+            batch_size=batch, prefetch=prefetch, limiter=limiter, name=str(index),
+            client_factory=lambda context: MemoryClient(context, broker))
+        handlers.append((handler, threading.Thread(target=handler.listen, daemon=True)))
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+
+    for _, thread in handlers:
+        thread.start()
+    if args.rate:
+        threading.Thread(target=publish, daemon=True).start()
+
+    stats = request(stats_url)
+    while stats['count'] < args.messages and time.monotonic() - start < args.timeout:
+        time.sleep(0.05)
+        stats = request(stats_url)
+
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+
+    server.SHUTTING_DOWN = True
+    for handler, thread in handlers:
+        if handler.rabbit is not None:
+            handler.stop()
+        thread.join(timeout=10)
+
+    latencies = stats['latencies']
+    return {
+        'size': size, 'connections': connections, 'prefetch': prefetch, 'batch': batch,
+        'messages': stats['count'], 'invocations': stats['invocations'], 'throttled': stats['throttled'],
+        'seconds': round(elapsed, 3),
+        'throughput': round(stats['count'] / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'cpu_us_per_message': round(cpu / max(stats['count'], 1) * 1000000, 1),
+        'complete': stats['count'] >= args.messages
+    }
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description='Offline listener throughput benchmark')
+    parser.add_argument('--messages', type=int, default=2000, help='messages per run')
+    parser.add_argument('--sizes', type=int_list, default=[100, 10000], help='message sizes, in bytes')
+    parser.add_argument('--connections', type=int_list, default=[1, 4], help='listener connections')
+    parser.add_argument('--prefetch', type=int_list, default=[1, 16], help='prefetch counts')
+    parser.add_argument('--batch', type=int_list, default=[1], help='batch sizes')
+    parser.add_argument('--latency-ms', type=float, default=20, help='action endpoint latency')
+    parser.add_argument('--limit', type=int, default=0, help='concurrent invocations before the endpoint throttles, 0 for none')
+    parser.add_argument('--rate', type=float, default=0, help='messages published per second, 0 to drain a full queue')
+    parser.add_argument('--retries', type=int, default=10, help='invocation attempts per message')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds allowed per run')
+    parser.add_argument('--output', help='file for the JSON lines results, default stdout')
+    args = parser.parse_args()
+
+    #The per message log lines would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+
+    ports = multiprocessing.Queue()
+    action = multiprocessing.Process(target=serve_action, args=(ports, args.latency_ms / 1000.0, args.limit), daemon=True)
+    action.start()
+    base_url = 'http://127.0.0.1:{0}'.format(ports.get(timeout=10))
+
+    whisk_context = whisk.WhiskContext(base_url, 'bench:bench', 'bench')
+    stats_url = base_url + '/stats'
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for size, connections, prefetch, batch in itertools.product(args.sizes, args.connections, args.prefetch, args.batch):
+            result = run_case(whisk_context, stats_url, args, size, connections, prefetch, batch)
+            result['latency_ms'] = args.latency_ms
+            result['limit'] = args.limit
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        action.terminate()
+
+
+if __name__ == '__main__':
+    main()
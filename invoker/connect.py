@@ -57,7 +57,8 @@ def main():
     try:
         LOGGER.info("Connecting...")
 
-        with rabbitmq.RabbitClient(context) as _:
+        #Checking out of a pool also checks that the connection is healthy
+        with rabbitmq.RabbitPool(context, max_connections=1) as pool, pool.client() as _:
             success = True
             LOGGER.info("Success.")
     except KeyboardInterrupt:
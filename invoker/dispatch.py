@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Pool of invoker workers fed by a bounded work queue.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import json
+import zlib
+import queue
+import logging
+import itertools
+import threading
+
+from concurrent.futures import Future
+
+LOGGER = logging.getLogger(__package__)
+
+
+class BoundedExecutor:
+    """
+        Runs submitted work on a fixed number of worker threads. Unlike a
+        ThreadPoolExecutor, the work queue is bounded, so submit blocks
+        (applying backpressure to the consumer) when the queue is full
+    """
+    def __init__(self, workers, queue_size):
+        self.work = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.stopped = False
+
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.run, name='invoker-{0}'.format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, func, *args):
+        """
+            Queues func(*args) to be run by a worker, blocking whilst the queue is full
+
+            Throws:
+                RuntimeError if the executor has been shut down
+
+            Returns:
+                A Future for the result of func
+        """
+        if self.stopped:
+            raise RuntimeError("Cannot submit work after shutdown")
+        future = Future()
+        self.work.put((future, func, args))
+        return future
+
+    def qsize(self):
+        """Number of submissions waiting for a worker"""
+        return self.work.qsize()
+
+    def run(self):
+        """
+            A worker thread, runs queued work until shutdown
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        while True:
+            item = self.work.get()
+            if item is None:
+                break
+
+            future, func, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(func(*args))
+            except Exception as expt:
+                LOGGER.error("Worker Exception: %r", expt)
+                future.set_exception(expt)
+
+    def shutdown(self, wait=True):
+        """
+            Stops the workers once the queued work has been run
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        self.stopped = True
+        for _ in self.threads:
+            self.work.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+class PartitionedExecutor:
+    """
+        Runs submitted work on a number of lanes, each a single worker with a
+        bounded queue. Work submitted with the same key always runs on the same
+        lane, so it runs in the order it was submitted, whilst work for
+        different keys runs in parallel
+    """
+    def __init__(self, lanes, queue_size):
+        lane_queue_size = max(queue_size // lanes, 1)
+        self.lanes = [BoundedExecutor(1, lane_queue_size) for _ in range(0, lanes)]
+        self.next_lane = itertools.cycle(self.lanes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def lane(self, key):
+        """
+            The lane for a key, within this executor only. Messages with the
+            same key may reach other consumers (connections or processes), and
+            redeliveries may arrive late, so ordering by key only holds for the
+            messages a single consumer receives
+        """
+        return self.lanes[zlib.crc32(str(key).encode('utf-8')) % len(self.lanes)]
+
+    def submit(self, func, *args):
+        """
+            Queues func(*args) on the next lane in turn, for work with no key
+
+            Throws:
+                RuntimeError if the executor has been shut down
+
+            Returns:
+                A Future for the result of func
+        """
+        return next(self.next_lane).submit(func, *args)
+
+    def submit_keyed(self, key, func, *args):
+        """
+            Queues func(*args) on the lane for key, blocking whilst that lane is
+            full. Work without a key (None) has no ordering to keep, so is
+            spread across the lanes
+
+            Throws:
+                RuntimeError if the executor has been shut down
+
+            Returns:
+                A Future for the result of func
+        """
+        if key is None:
+            return self.submit(func, *args)
+        return self.lane(key).submit(func, *args)
+
+    def qsize(self):
+        """Number of submissions waiting for a lane"""
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def shutdown(self, wait=True):
+        """
+            Stops the lanes once the queued work has been run
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        for lane in self.lanes:
+            lane.shutdown(wait=False)
+
+        if wait:
+            for lane in self.lanes:
+                for thread in lane.threads:
+                    thread.join()
+
+
+def partition_key(spec):
+    """
+        Makes a function that extracts the partition key of a message, either
+        from a header ('header:<name>') or from the JSON body ('json:<path>',
+        a dotted path such as 'device.id', where a number indexes a list)
+
+        Throws:
+            ValueError if the spec is not valid
+
+        Returns:
+            A function of the message properties and body, returning the key,
+            or None if the message has no key
+    """
+    source, _, name = spec.partition(':')
+    if not name:
+        raise ValueError("Partition key must be header:<name> or json:<path>, not {0!r}".format(spec))
+
+    if source == 'header':
+        def key(properties, body):
+            return (properties.headers or {}).get(name)
+        return key
+
+    if source == 'json':
+        if name.startswith('$.'):
+            name = name[2:]
+        path = [int(part) if part.isdigit() else part for part in name.split('.')]
+
+        def key(properties, body):
+            try:
+                value = json.loads(str(body, 'utf-8'))
+                for part in path:
+                    value = value[part]
+            except (ValueError, LookupError, TypeError):
+                return None
+            return value
+        return key
+
+    raise ValueError("Partition key must be header:<name> or json:<path>, not {0!r}".format(spec))
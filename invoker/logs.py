@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Low overhead logging for the per-message path of the listener.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import time
+import queue
+import random
+import logging
+import logging.handlers
+import threading
+
+LOGGER = logging.getLogger(__package__)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+        Queues records for the background writer, without formatting them.
+        Whilst the queue is full, records below WARNING are dropped (and
+        counted) rather than holding up the thread that logged them
+    """
+    def __init__(self, records):
+        super(DroppingQueueHandler, self).__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        #The message and any exception are formatted by the writer thread.
+        #The records stay in this process, so need not be made picklable
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BlockingQueueListener(logging.handlers.QueueListener):
+    """A QueueListener that waits for room in the queue to stop, so no record is lost"""
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class BackgroundWriter():
+    """
+        Moves the handlers of a logger (by default the root logger) to a
+        background thread, so other threads only queue their records. At
+        most queue_size records wait to be written
+    """
+    def __init__(self, logger=None, queue_size=10000):
+        self.logger = logger or logging.getLogger()
+        self.handlers = []
+        records = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(records)
+        self.listener = None
+
+    @property
+    def dropped(self):
+        """The number of records dropped whilst the queue was full"""
+        return self.handler.dropped
+
+    def start(self):
+        """
+            Starts writing in the background
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        self.handlers = self.logger.handlers[:]
+        self.listener = BlockingQueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self):
+        """
+            Writes the records still queued, then puts the handlers back on the logger
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        if self.listener is None:
+            return
+
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        self.listener = None
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+
+
+class Summary():
+    """
+        Totals the counts of events by key, logging one line per key every
+        interval seconds in place of a line per event (none, if interval is 0).
+        sampled() picks the events that are still worth a line of their own,
+        a fraction sample of them and at most rate a second (no limit if 0)
+    """
+    def __init__(self, title, fields, interval=0, sample=1.0, rate=0):
+        self.title = title
+        self.fields = fields
+        self.interval = interval
+        self.sample = sample
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.started = time.monotonic()
+        #A token bucket, holding up to a second of sampled lines (at least one)
+        self.tokens = max(float(rate), 1.0)
+        self.filled = self.started
+
+    def configure(self, interval=0, sample=1.0, rate=0):
+        """Changes the settings, before any event is added"""
+        self.interval = interval
+        self.sample = sample
+        self.rate = rate
+        self.tokens = max(float(rate), 1.0)
+        self.started = self.filled = time.monotonic()
+
+    def add(self, key, *counts):
+        """
+            Adds the counts of an event, for each of the fields, to the totals
+            for its key, logging the totals if interval seconds have passed
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        if self.interval <= 0:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = [0] * len(self.fields)
+            for index, count in enumerate(counts):
+                totals[index] += count
+
+            if now - self.started < self.interval:
+                return
+            totals, self.totals = self.totals, {}
+            seconds, self.started = now - self.started, now
+
+        self.log(totals, seconds)
+
+    def sampled(self):
+        """
+            Decides whether an event should be logged in full
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                True if it should
+        """
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        if self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.tokens + (now - self.filled) * self.rate, max(float(self.rate), 1.0))
+            self.filled = now
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def flush(self):
+        """Logs the totals so far, on shutdown"""
+        with self.lock:
+            totals, self.totals = self.totals, {}
+            seconds, self.started = time.monotonic() - self.started, time.monotonic()
+        self.log(totals, seconds)
+
+    def log(self, totals, seconds):
+        """Logs a line for the totals of each key"""
+        for key, counts in sorted(totals.items(), key=lambda item: str(item[0])):
+            LOGGER.info("%s: %s: %s in %.1fs", self.title, key,
+                        ', '.join('{0} {1}'.format(count, field) for field, count in zip(self.fields, counts)),
+                        seconds)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Prometheus style metrics for the listener.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import bisect
+import logging
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+LOGGER = logging.getLogger(__package__)
+
+#All metrics, in the order they were created
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 5242880)
+
+
+def format_labels(names, values, extra=''):
+    """Prometheus label set, e.g. {thread="1"}"""
+    pairs = ['{0}="{1}"'.format(name, value) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def sort_key(item):
+    """Orders values by their label values, which may be of mixed types"""
+    return [str(value) for value in item[0]]
+
+
+class Metric:
+    """A named metric, with a value per set of label values"""
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        """
+            Exposition of the metric, in the Prometheus text format
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                A list of lines
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values, key=sort_key):
+            lines.append('{0}{1} {2}'.format(self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Counter(Metric):
+    """A value that only increases"""
+    kind = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        """Increase the count for the label values"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self):
+        """The count across all label values"""
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from a function when scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        super(Gauge, self).__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, *label_values):
+        """Set the value for the label values"""
+        with self.lock:
+            self.values[label_values] = value
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super(Gauge, self).render()
+
+
+class Histogram(Metric):
+    """Counts of observed values, in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        """Record a value for the label values"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                #One count per bucket, then +Inf, then the sum of the values
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self.lock:
+            values = [(label_values, list(counts)) for label_values, counts in self.values.items()]
+
+        for label_values, counts in sorted(values, key=sort_key):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                labels = format_labels(self.labels, label_values, 'le="{0}"'.format(bound))
+                lines.append('{0}_bucket{1} {2}'.format(self.name, labels, total))
+            labels = format_labels(self.labels, label_values)
+            lines.append('{0}_sum{1} {2}'.format(self.name, labels, counts[-1]))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels, total))
+        return lines
+
+
+def render():
+    """All metrics, in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics"""
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        #Scrapes are too frequent to log
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """MetricsServer"""
+    daemon_threads = True
+
+
+def start_server(port):
+    """
+        Serves the metrics on http://<host>:port/metrics from a background thread
+
+        Throws:
+            An exception if the port cannot be bound
+
+        Returns:
+            The server
+    """
+    server = MetricsServer(('', port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    LOGGER.info("Metrics on port %d", port)
+    return server
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Cloud Function invocation payloads.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import json
+import base64
+
+from messenger import rabbitmq
+
+#Largest payload that can be sent whilst invoking an action
+MAX_PAYLOAD = 5242880
+
+#The payload is {"messages": [...]}, byte for byte what json.dumps would produce
+PREFIX = b'{"messages": ['
+SEPARATOR = b', '
+SUFFIX = b']}'
+#Bytes of the payload around the message bodies
+OVERHEAD = len(PREFIX) + len(SUFFIX)
+
+
+def reject_constant(name):
+    """
+        Refuses the NaN and Infinity that json.loads accepts, but that are not
+        JSON and that Openwhisk would fail to parse
+
+        Throws:
+            ValueError always
+
+        Returns:
+            Nothing
+    """
+    raise ValueError("Not a JSON value: {0}".format(name))
+
+
+def encode_message(body, raw_json=False):
+    """
+        JSON encodes a single message body. With raw_json, a body that is
+        already valid JSON is embedded as is, rather than as an escaped string
+
+        Throws:
+            UnicodeDecodeError if the body is not valid UTF-8
+
+        Returns:
+            The encoded body, as bytes
+    """
+    if isinstance(body, str):
+        return json.dumps(body).encode('ascii')
+
+    if raw_json:
+        try:
+            json.loads(str(body, 'utf-8'), parse_constant=reject_constant)
+            return body
+        except ValueError:
+            pass
+
+    #The default ensure_ascii output needs no further encoding
+    return json.dumps(str(body, 'utf-8')).encode('ascii')
+
+
+def encoded_size(body, raw_json=False):
+    """
+        The number of bytes a message body adds to an invocation payload, its
+        JSON encoding and a separator, for sizing batches
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            The size in bytes
+    """
+    try:
+        return len(encode_message(body, raw_json)) + len(SEPARATOR)
+    except UnicodeDecodeError:
+        #The batch fails to build whatever its size
+        return len(body)
+
+
+def build(bodies, raw_json=False):
+    """
+        Builds the invocation payload for a list of message bodies (bytes,
+        memoryview or str), copying each encoded body into the payload once
+
+        Throws:
+            UnicodeDecodeError if a body is not valid UTF-8
+
+        Returns:
+            The payload, as bytes ready to be posted
+    """
+    return b''.join((PREFIX, SEPARATOR.join([encode_message(body, raw_json) for body in bodies]), SUFFIX))
+
+
+def compress(json_msg, encoding):
+    """
+        Compresses an invocation payload. The action receives the content
+        encoding and the base64 encoded, compressed payload as its encoding
+        and data parameters, see action/client.py
+
+        Throws:
+            ValueError if the encoding is not supported
+
+        Returns:
+            The compressed payload, as bytes ready to be posted
+    """
+    data = base64.b64encode(rabbitmq.compress(json_msg, encoding))
+    return b''.join((b'{"encoding": ', json.dumps(encoding).encode('ascii'), b', "data": "', data, b'"}'))
+
+
+def replies(result, count):
+    """
+        Splits the result of a blocking invocation into a reply for each of the
+        count messages invoked. A result holding a list of count replies, as
+        its replies entry, gives each message its own, otherwise every message
+        gets the whole result
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            A list of JSON encoded replies, as bytes
+    """
+    entries = result.get('replies') if isinstance(result, dict) else None
+    if isinstance(entries, list) and len(entries) == count:
+        return [json.dumps(entry).encode('utf-8') for entry in entries]
+    return [json.dumps(result).encode('utf-8')] * count
@@ -22,8 +22,12 @@
 
 import os
 import json
+import uuid
 import timeit
 import logging
+
+import pika
+
 from messenger import rabbitmq
 
 #Set up logger
@@ -62,30 +66,64 @@ def main():
     cert = getenv('CERT', 'cert.pem')
     feed_queue = getenv('FEED_QUEUE')
     reply_queue = getenv('REPLY_QUEUE')
+    compression = os.getenv('RABBIT_COMPRESSION') or None
+    #The listener publishes the replies, see WHISK_RPC
+    rpc = getenv('WHISK_RPC', 'false') == 'true'
 
     messages = 10
     LOGGER.info("Starting...")
 
     context = rabbitmq.RabbitContext(host, port, user, password, vhost, cert=cert)
+    #The replies are consumed over the connection the requests were published on
+    pool = rabbitmq.RabbitPool(context, max_connections=1, factory=rabbitmq.RabbitClient)
 
     try:
         start = timeit.default_timer()
 
         LOGGER.info("Sending requests to: %r", format(feed_queue))
 
-        with rabbitmq.RabbitClient(context) as client:
+        with pool.client() as client:
             client.start_queue(queue=rabbitmq.RabbitQueue(feed_queue))
+            client.confirm_delivery()
+            client.compression = compression
             message = {"serviceRequest" : "none"}
 
-            for _ in range(0, messages):
-                client.publish(json.dumps(message))
+            if rpc:
+                #Each request is matched with its reply by correlation id
+                sent = {}
+                for _ in range(0, messages):
+                    correlation_id = uuid.uuid4().hex
+                    sent[correlation_id] = timeit.default_timer()
+                    client.publish(json.dumps(message), properties=pika.BasicProperties(
+                        delivery_mode=2, reply_to=reply_queue, correlation_id=correlation_id))
+            else:
+                failures = client.publish_many(json.dumps(message) for _ in range(0, messages))
+                if failures:
+                    LOGGER.info("Failed messages: %r", len(failures))
+
+            nacked = client.wait_for_confirms()
+            if nacked:
+                LOGGER.info("Rejected messages: %r", len(nacked))
 
         LOGGER.info("Dispatched messages: %r", client.outbound)
         LOGGER.info("Now wait for replies on: %r", reply_queue)
 
-        with rabbitmq.RabbitClient(context) as client:
+        with pool.client() as client:
             client.start_queue(queue=rabbitmq.RabbitQueue(reply_queue))
-            client.receive(lambda x: None, max_messages=messages)
+            if rpc:
+                latencies = []
+                for delivery in client.stream(timeout=30):
+                    delivery.ack()
+                    request = sent.pop(delivery.properties.correlation_id, None)
+                    if request is not None:
+                        latencies.append(timeit.default_timer() - request)
+                    if not sent:
+                        break
+                if latencies:
+                    LOGGER.info("Round trip latency, mean: %r, max: %r",
+                                round(sum(latencies) / len(latencies), 3), round(max(latencies), 3))
+            else:
+                client.receive(lambda x: None, max_messages=messages)
 
         LOGGER.info("Received messages: %r", client.inbound)
         stop = round(timeit.default_timer() - start, 2)
@@ -95,6 +133,8 @@ def main():
         LOGGER.info("Stopping")
     except Exception as err:
         LOGGER.info("Error %r", err)
+    finally:
+        pool.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Routing table, mapping queues to Cloud Function actions.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import json
+
+import payload
+
+#Settings a route may have, anything else is a mistake in the table
+SETTINGS = ('queue', 'action', 'exchange', 'binding_keys', 'consumers', 'prefetch',
+            'batch_size', 'batch_bytes', 'batch_wait', 'retries', 'payload')
+
+
+class Route():
+    """
+        Holds the settings for consuming one queue and invoking one action.
+        With an exchange, the queue is bound to it with each of the binding keys
+    """
+    def __init__(self, queue, action, exchange=None, binding_keys=None, consumers=1, prefetch=1,
+                 batch_size=1, batch_bytes=payload.MAX_PAYLOAD, batch_wait=100, retries=10, payload='string'):
+        self.queue = queue
+        self.action = action
+        self.exchange = exchange
+        self.binding_keys = binding_keys or ([queue] if exchange is not None else [])
+        self.consumers = max(int(consumers), 1)
+        self.prefetch = max(int(prefetch), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_bytes = int(batch_bytes)
+        #Milliseconds, as for WHISK_BATCH_WAIT
+        self.batch_wait = int(batch_wait) / 1000.0
+        self.retries = int(retries)
+        self.raw_json = payload == 'json'
+
+    def channel_prefetch(self):
+        """Unacknowledged messages each consumer of the route may hold"""
+        #A batch is acked in one go, so only one batch may be in flight
+        return self.batch_size if self.batch_size > 1 else self.prefetch
+
+    def concurrency(self):
+        """Invocations the route may have in flight at once"""
+        return self.consumers * (1 if self.batch_size > 1 else self.prefetch)
+
+
+def load_routes(value, defaults=None):
+    """
+        Parses a routing table, a JSON list of routes, or the name of a file
+        holding one. Settings missing from a route are taken from defaults
+
+        Throws:
+            ValueError if the table is not valid
+
+        Returns:
+            A list of Routes
+    """
+    if not value.lstrip().startswith('['):
+        with open(value) as table:
+            value = table.read()
+
+    routes = []
+    for entry in json.loads(value):
+        unknown = set(entry) - set(SETTINGS)
+        if unknown:
+            raise ValueError("Unknown route settings: {0}".format(sorted(unknown)))
+        if 'queue' not in entry or 'action' not in entry:
+            raise ValueError("Each route needs a queue and an action: {0!r}".format(entry))
+
+        settings = dict(defaults or {})
+        settings.update(entry)
+        routes.append(Route(**settings))
+
+    if not routes:
+        raise ValueError("The routing table is empty")
+    return routes
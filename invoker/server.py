@@ -22,10 +22,14 @@
 
 import os
 import signal
-import json
 import time
+import functools
+import itertools
+import threading
 import traceback
 import logging
+import multiprocessing
+import multiprocessing.connection
 
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import wait
@@ -34,6 +38,14 @@ from concurrent.futures import FIRST_COMPLETED
 from messenger import rabbitmq
 
 import whisk
+import dispatch
+import throttle
+import payload
+import metrics
+import spill
+import routing
+import autoscale
+import logs
 
 #Set up logger
 logging.basicConfig(
@@ -46,10 +58,69 @@ LOGGER = logging.getLogger(__package__)
 #Global variable to tell threads to shutdown
 SHUTTING_DOWN = False
 
+#Largest payload that can be sent whilst invoking an action
+MAX_PAYLOAD = payload.MAX_PAYLOAD
+
+MESSAGES = metrics.Counter('rabbitwhisker_messages_total', 'Messages received', ('thread',))
+OUTCOMES = metrics.Counter('rabbitwhisker_handled_total', 'Messages acked or returned to the queue', ('thread', 'outcome'))
+RETRIES = metrics.Counter('rabbitwhisker_retries_total', 'Action invocation retries', ('thread',))
+RECONNECTS = metrics.Counter('rabbitwhisker_reconnects_total', 'Listener reconnections', ('thread',))
+INVOCATION_SECONDS = metrics.Histogram('rabbitwhisker_invocation_seconds', 'Action invocation latency', ('status',))
+PAYLOAD_BYTES = metrics.Histogram('rabbitwhisker_payload_bytes', 'Invocation payload sizes', buckets=metrics.SIZE_BUCKETS)
+
+#Invocation responses, logged one by one unless summarised, see LOG_SUMMARY
+RESPONSES = logs.Summary('Responses', ('invocations', 'messages', 'retries', 'failed'))
+
+
+class Readiness:
+    """
+        Signals once every connection opened on start up is ready, so that a deploy
+        can tell when the listener is taking traffic
+    """
+    def __init__(self, names):
+        self.pending = set(names)
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.seconds = None
+
+    def ready(self, name):
+        """
+            Counts in a connection, reconnections are ignored
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        with self.lock:
+            if name not in self.pending:
+                return
+            self.pending.discard(name)
+            if self.pending:
+                return
+            self.seconds = time.monotonic() - self.started
+
+        LOGGER.info("Ready in %.3fs.", self.seconds)
+        self.event.set()
+
+    def is_ready(self):
+        """Whether every connection is ready"""
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for every connection to be ready, returning whether they are"""
+        return self.event.wait(timeout)
+
 
 class MessageHandlerThread:
     """handle relay from rabbitmq to openwhisk"""
-    def __init__(self, whisk_context, rabbit_context, subscribe, timeout_seconds, whisk_retries, action):
+    def __init__(self, whisk_context, rabbit_context, subscribe, timeout_seconds, whisk_retries, action,
+                 batch_size=1, batch_bytes=MAX_PAYLOAD, batch_wait=0.1, prefetch=1, executor=None,
+                 limiter=None, backoff_base=0.1, backoff_max=30.0, raw_json=False, name='0',
+                 client_factory=None, spill_store=None, standby=None, reconnect_base=0.1, reconnect_max=10.0,
+                 partition=None, encoding=None, dead_letter=None, readiness=None, rpc=False, completed=None):
         self.rabbit = None
         self.invoker = None
         self.whisk_context = whisk_context
@@ -58,6 +129,39 @@ class MessageHandlerThread:
         self.subscribe = subscribe
         self.timeout_seconds = timeout_seconds
         self.whisk_retries = whisk_retries
+        self.batch_size = batch_size
+        #Batches are sized by the JSON encoded bodies, so the payload stays within MAX_PAYLOAD
+        self.batch_bytes = min(batch_bytes, MAX_PAYLOAD) - payload.OVERHEAD
+        self.measure = functools.partial(payload.encoded_size, raw_json=raw_json)
+        self.batch_wait = batch_wait
+        self.prefetch = prefetch
+        self.executor = executor
+        self.limiter = limiter or throttle.AdaptiveLimiter(prefetch)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.raw_json = raw_json
+        self.name = name
+        self.client_factory = client_factory or functools.partial(rabbitmq.RabbitClient, connection_attempts=1)
+        self.spill = spill_store
+        self.standby = standby
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.partition = partition
+        self.encoding = encoding
+        #Makes the RabbitDeadLetter for each connection, if dead lettering
+        self.dead_letter = dead_letter
+        self.readiness = readiness
+        #Set once the handler is to stop for good, when scaling down
+        self.retired = False
+        #Waits for the result of each invocation, replying with it
+        self.rpc = rpc
+        #The RabbitCompleted shared by every connection, if suppressing redeliveries
+        self.completed = completed
+
+    def ready(self, connection):
+        """Counts in the RabbitMQ or OpenWhisk connection of the handler, on start up"""
+        if self.readiness is not None:
+            self.readiness.ready('{0}-{1}'.format(connection, self.name))
 
     def send_to_whisk(self, recv_msg):
         """
@@ -70,40 +174,120 @@ class MessageHandlerThread:
             Returns:
                 True if the message was handled, otherwise False
         """
+        return self.send_batch_to_whisk([recv_msg])
+
+    def send_batch_to_whisk(self, recv_msgs):
+        """
+            Callback to handle a batch of received messages, attempt to invoke an
+            action once with all message bodies as a parameter to the action
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                True (a RabbitReply with the result in RPC mode) if the messages were handled,
+                otherwise a RabbitFailure when dead lettering or the failure is permanent,
+                or False to return the messages to the queue
+        """
 
         retry = 0
+        recv_msg_size = 0
+        result = None
+        handled = False
+        failure = None
 
         #LOGGER.info("Received message")
 
         try:
-            recv_msg_size = len(recv_msg)
-            if recv_msg_size > 5242880:
+            MESSAGES.inc(len(recv_msgs), self.name)
+            recv_msg_size = sum(len(recv_msg) for recv_msg in recv_msgs)
+            PAYLOAD_BYTES.observe(recv_msg_size)
+
+            json_msg = payload.build(recv_msgs, self.raw_json)
+            if self.encoding is not None:
+                #Compressed before the size check, so larger messages can be sent
+                json_msg = payload.compress(json_msg, self.encoding)
+            payload_size = len(json_msg)
+
+            if payload_size > MAX_PAYLOAD:
                 #Need to ensure we dont send to much data whilst invoking the action
-                raise BufferError("Message payload too large; {0} > 5242880 bytes!".format(recv_msg_size))
+                raise BufferError("Message payload too large; {0} > {1} bytes!".format(payload_size, MAX_PAYLOAD))
+
+            #Whilst the action cannot be invoked, keep draining the queue to disk
+            if self.spill is not None and self.spill.outage and self.spill.append(recv_msgs):
+                OUTCOMES.inc(len(recv_msgs), self.name, 'spill')
+                return True
 
             #Its possible to have too many inflight whisk activations
-            #So we'll need to retry if this error occurs
+            #So we'll need to retry if this error occurs. With a dead letter
+            #exchange, the message is retried later, from a delay queue, instead
+            attempts = 1 if self.dead_letter is not None else self.whisk_retries
+
+            while retry < attempts and not SHUTTING_DOWN:
+                #Wait for a share of the in-flight invocations allowed across all threads
+                if not self.limiter.acquire(timeout=1):
+                    continue
 
-            while retry < self.whisk_retries and not SHUTTING_DOWN:
-                if isinstance(recv_msg, bytes):
-                    message = {'messages': [recv_msg.decode()]}
-                else:
-                    message = {'messages': [recv_msg]}
+                start = time.monotonic()
+                throttled = True
+                try:
+                    status, result = self.invoker.post(json_msg, self.action)
+                    #In RPC mode, the error of an action that ran is its reply, not a throttled invocation
+                    action_error = self.rpc and whisk.is_action_error(status, result)
+                    throttled = throttle.is_throttled(status) and not action_error
+                finally:
+                    #Always give the permit back, an invocation that raised counts as throttled
+                    latency = time.monotonic() - start
+                    self.limiter.release(throttled, latency)
+                INVOCATION_SECONDS.observe(latency, status if status is not None else 'error')
+                if 'error' not in result or action_error:
+                    handled = True
+                    break
 
-                result = self.invoker.invoke(json.dumps(message), self.action)
-                if 'error' not in result:
+                failure = rabbitmq.RabbitFailure(result['error'], whisk.is_permanent(status), status)
+                if failure.permanent:
+                    #Retrying would only tie up this thread
                     break
 
-                time.sleep(1)
+                RETRIES.inc(1, self.name)
                 retry += 1
+                if retry < attempts:
+                    time.sleep(throttle.backoff(retry - 1, self.backoff_base, self.backoff_max))
 
-            LOGGER.info("Response: %r:%r retries...%r", self.action, retry, result)
+            RESPONSES.add(self.action, 1, len(recv_msgs), retry, 0 if handled else 1)
+            #Failures are always logged in full
+            if not handled:
+                LOGGER.warning("Response: %r:%r messages:%r retries...%r", self.action, len(recv_msgs), retry, result)
+            elif RESPONSES.sampled():
+                LOGGER.info("Response: %r:%r messages:%r retries...%r", self.action, len(recv_msgs), retry, result)
+
+            if self.spill is not None and failure is not None and not failure.permanent and not handled \
+                    and self.spill.append(recv_msgs):
+                LOGGER.info("Spilled %r messages to disk", len(recv_msgs))
+                self.spill.outage = True
+                OUTCOMES.inc(len(recv_msgs), self.name, 'spill')
+                return True
         except Exception as expt:
-            LOGGER.info("Message Error: %r", expt)
-            LOGGER.info("Received: %d bytes", recv_msg_size)
-            LOGGER.info("Received: %s", recv_msg[:1000])
+            LOGGER.error("Message Error: %r", expt)
+            LOGGER.error("Received: %d messages, %d bytes", len(recv_msgs), recv_msg_size)
+            LOGGER.error("Received: %s", recv_msgs[0][:1000])
+            #Messages that are too large, or not UTF-8, will never be sent
+            failure = rabbitmq.RabbitFailure(repr(expt), isinstance(expt, (BufferError, UnicodeError)))
+
+        if handled:
+            OUTCOMES.inc(len(recv_msgs), self.name, 'ack')
+            if self.rpc:
+                return rabbitmq.RabbitReply(payload.replies(result, len(recv_msgs)), 'application/json')
+            return True
+
+        #Without a dead letter exchange, a permanent failure is still not requeued,
+        #since it would be redelivered, and fail, straight away
+        if failure is not None and (self.dead_letter is not None or failure.permanent):
+            OUTCOMES.inc(len(recv_msgs), self.name, 'permanent' if failure.permanent else 'transient')
+            return failure
 
-        return retry == 0
+        OUTCOMES.inc(len(recv_msgs), self.name, 'nack')
+        return False
 
     def stop(self):
         """
@@ -118,9 +302,108 @@ class MessageHandlerThread:
         """
         self.rabbit.stop()
 
+    def retire(self):
+        """
+            Stops the handler for good: it stops consuming, returning the messages it
+            has not started on to the queue, acks the rest once handled, then disconnects
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        self.retired = True
+        try:
+            if self.rabbit is not None:
+                self.rabbit.drain()
+        except Exception:
+            #Not consuming, listen notices the flag instead
+            pass
+
+    def connect(self):
+        """
+            Connects to RabbitMQ, taking over the standby connection if there is one
+
+            Throws:
+                An exception if the connection attempt is not successful
+
+            Returns:
+                A RabbitClient
+        """
+        if self.standby is not None:
+            client = self.standby.take()
+            if client is not None:
+                LOGGER.info("Using standby connection to RabbitMQ...")
+                return client
+
+        LOGGER.info("Connecting to RabbitMQ...")
+        return self.client_factory(self.rabbit_context)
+
+    def consume(self):
+        """
+            Starts the RabbitMQ message consumption on the current connection
+
+            Throws:
+                An exception if consumption fails, the connection may be broken
+
+            Returns:
+                Nothing
+        """
+        if self.batch_size > 1:
+            #A batch is acked in one go, so only one batch may be in flight
+            prefetch = self.batch_size
+        else:
+            prefetch = self.prefetch
+
+        self.rabbit.start_queue(
+            queue=rabbitmq.RabbitQueue(self.subscribe),
+            prefetch=prefetch)
+
+        LOGGER.info("Waiting on %r...", self.subscribe)
+        self.ready('rabbit')
+
+        #Retired whilst declaring the queue, when there was no consumer to cancel
+        if self.retired:
+            return
+
+        #Blocks indefinitely
+        if self.batch_size > 1:
+            self.rabbit.receive_batch(
+                self.send_batch_to_whisk, self.batch_size, self.batch_bytes,
+                self.batch_wait, self.timeout_seconds, self.measure)
+        elif self.executor is not None:
+            #Hand messages to the shared invoker workers, which may block
+            #this consumer whilst their work queue is full
+            self.rabbit.receive(self.send_to_whisk, self.timeout_seconds, executor=self.executor,
+                                partition=self.partition)
+        elif self.prefetch > 1:
+            #Handle up to prefetch messages at once, acking each as it completes
+            with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+                self.rabbit.receive(self.send_to_whisk, self.timeout_seconds, executor=executor)
+        else:
+            self.rabbit.receive(self.send_to_whisk, self.timeout_seconds)
+
+    def open_invoker(self):
+        """
+            Connects to OpenWhisk, opening the pooled connections for the action
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        LOGGER.info("Connecting to OpenWhisk...")
+        self.invoker = whisk.WhiskInvoker(self.whisk_context, pool_size=self.prefetch, **rpc_params(self.rpc))
+        self.invoker.preconnect(self.action, self.prefetch)
+        self.ready('whisk')
+
     def listen(self):
         """
-            A thread, that starts the RabbitMQ message consumption
+            A thread, that starts the RabbitMQ message consumption, reconnecting
+            to RabbitMQ if the connection fails. The connections to OpenWhisk
+            are kept whilst reconnecting to RabbitMQ
 
             Throws:
                 No exceptions thrown
@@ -128,27 +411,139 @@ class MessageHandlerThread:
             Returns:
                 Nothing
         """
-        while not SHUTTING_DOWN:
-            try:
-                LOGGER.info("Connecting to OpenWhisk...")
+        #Connect to OpenWhisk whilst connecting to RabbitMQ, rather than one after the other
+        opening = threading.Thread(target=self.open_invoker, name='whisk-' + self.name, daemon=True)
+        opening.start()
 
-                with whisk.WhiskInvoker(self.whisk_context) as self.invoker:
-                    LOGGER.info("Connecting to RabbitMQ...")
+        def consume():
+            opening.join()
+            if self.retired:
+                return
+            self.consume()
+            LOGGER.info("Timed out or interrupted.")
 
-                    with rabbitmq.RabbitClient(self.rabbit_context) as self.rabbit:
-                        self.rabbit.start_queue(queue=rabbitmq.RabbitQueue(self.subscribe))
+        try:
+            keep_listening(self, lambda: not SHUTTING_DOWN and not self.retired, consume)
+        finally:
+            opening.join()
+            if self.invoker is not None:
+                self.invoker.close()
 
-                        LOGGER.info("Waiting on %r...", self.subscribe)
 
-                        #Blocks indefinitely
-                        self.rabbit.receive(self.send_to_whisk, self.timeout_seconds)
-                        LOGGER.info("Timed out or interrupted.")
-            except Exception as expt:
-                LOGGER.error("Listener Exception: %r", expt)
-                traceback.print_exc()
-                #Brief pause before re-connecting
-                time.sleep(2)
+class RouteListenerThread:
+    """consume several routes, each on a channel of one RabbitMQ connection"""
+    def __init__(self, rabbit_context, routes, executor, name='0', client_factory=None,
+                 reconnect_base=0.1, reconnect_max=10.0, partition=None, dead_letter=None, readiness=None,
+                 completed=None):
+        self.rabbit = None
+        self.rabbit_context = rabbit_context
+        #(Route, MessageHandlerThread) tuples, the handler invokes the route's action
+        self.routes = routes
+        self.executor = executor
+        self.name = name
+        self.client_factory = client_factory or functools.partial(rabbitmq.RabbitClient, connection_attempts=1)
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.partition = partition
+        self.dead_letter = dead_letter
+        self.readiness = readiness
+        self.completed = completed
 
+    def connect(self):
+        """
+            Connects to RabbitMQ
+
+            Throws:
+                An exception if the connection attempt is not successful
+
+            Returns:
+                A RabbitClient
+        """
+        LOGGER.info("Connecting to RabbitMQ...")
+        return self.client_factory(self.rabbit_context)
+
+    def stop(self):
+        """
+            The listener stops once SHUTTING_DOWN is set, cancelling its consumers
+            and waiting for the outstanding messages to be acked
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        pass
+
+    def consume(self):
+        """
+            Subscribes to the queue of each route on the current connection, and
+            handles messages until shutting down
+
+            Throws:
+                An exception if consumption fails, the connection may be broken
+
+            Returns:
+                Nothing
+        """
+        for route, handler in self.routes:
+            self.rabbit.subscribe(
+                rabbitmq.RabbitQueue(route.queue),
+                handler.send_batch_to_whisk if route.batch_size > 1 else handler.send_to_whisk,
+                route.prefetch, self.executor, route.exchange, route.binding_keys,
+                route.batch_size, handler.batch_bytes, route.batch_wait, self.partition, handler.measure)
+
+        LOGGER.info("Waiting on %r...", [route.queue for route, _ in self.routes])
+        if self.readiness is not None:
+            self.readiness.ready('rabbit-' + self.name)
+
+        self.rabbit.run(lambda: not SHUTTING_DOWN)
+
+    def listen(self):
+        """
+            A thread, that starts the RabbitMQ message consumption, reconnecting
+            to RabbitMQ if the connection fails
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        keep_listening(self, lambda: not SHUTTING_DOWN, self.consume)
+
+
+def keep_listening(listener, running, consume):
+    """
+        Consumes, with consume(), over a connection from listener.connect() whilst
+        running() is True, reconnecting straight away if the connection fails
+        and backing off (with jitter) if failures continue. Each connection
+        gets the dead letter policy and completed messages of the listener
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            Nothing
+    """
+    failures = 0
+
+    while running():
+        try:
+            with listener.connect() as listener.rabbit:
+                failures = 0
+                if listener.dead_letter is not None:
+                    listener.rabbit.dead_letter = listener.dead_letter()
+                listener.rabbit.completed = listener.completed
+                consume()
+        except Exception as expt:
+            LOGGER.error("Listener Exception: %r", expt)
+            traceback.print_exc()
+            RECONNECTS.inc(1, listener.name)
+
+            #Retry quickly at first, backing off (with jitter) if failures continue
+            time.sleep(throttle.backoff(failures, listener.reconnect_base, listener.reconnect_max))
+            failures += 1
 
 
 def getenv(var, default=None):
@@ -173,53 +568,444 @@ def handle_sig(*args):
     raise KeyboardInterrupt()
 
 
+def supervise(num_processes):
+    """
+        Runs the listener in several worker processes, restarting any that stop,
+        and passing SIGTERM on to them so they drain before exiting
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            Nothing
+    """
+    processes = {}
+
+    def start(index):
+        process = multiprocessing.Process(target=serve_process, args=(index,), name='listener-{0}'.format(index))
+        process.start()
+        processes[index] = process
+        LOGGER.info("Started listener process %r", process.pid)
+
+    try:
+        for index in range(0, num_processes):
+            start(index)
+
+        while True:
+            try:
+                multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout=3600)
+
+                # Ordinarily, a process should never finish; if one has, start a replacement process.
+                for index, process in list(processes.items()):
+                    if not process.is_alive():
+                        LOGGER.error("Process %r stopped (%r); starting replacement...", process.pid, process.exitcode)
+                        #Brief pause, in case the process is failing on start up
+                        time.sleep(2)
+                        start(index)
+            except KeyboardInterrupt:
+                break
+            except Exception as expt:
+                LOGGER.error("Supervisor Loop: %r", expt)
+    finally:
+        LOGGER.info("Stopping processes...")
+
+        for process in processes.values():
+            if process.is_alive():
+                #Delivers SIGTERM, the process then stops its listeners
+                process.terminate()
+
+        for process in processes.values():
+            process.join()
+
+        LOGGER.info("Stopped processes.")
+
+
+def serve_process(index):
+    """listener process entry point"""
+    signal.signal(signal.SIGTERM, handle_sig)
+    serve(index)
+
+
 def main():
     """main"""
     signal.signal(signal.SIGTERM, handle_sig)
 
+    num_processes = int(getenv('RABBIT_PROCESSES', '1'))
+    if num_processes > 1:
+        supervise(num_processes)
+    else:
+        serve()
+
+
+def rpc_params(rpc):
+    """The invocation parameters, blocking for the result in RPC mode"""
+    if rpc:
+        return {'blocking': 'true', 'result': 'true'}
+    return {}
+
+
+def preconnect(invoker, action, connections, readiness, name):
+    """
+        Opens the OpenWhisk connections for an action, then counts them in
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            Nothing
+    """
+    invoker.preconnect(action, connections)
+    readiness.ready(name)
+
+
+def route_listeners(routes, invoker, whisk_context, rabbit_context, num_connections, timeout_seconds,
+                    executor, limiter, backoff_base, backoff_max, index=0, partition=None, encoding=None,
+                    dead_letter=None, readiness=None, rpc=False, completed=None):
+    """
+        Creates the listeners for a routing table, spreading the consumers of
+        every route across num_connections RabbitMQ connections
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            A list of RouteListenerThreads
+    """
+    subscriptions = []
+    for route in routes:
+        handler = MessageHandlerThread(
+            whisk_context, rabbit_context, route.queue, timeout_seconds, route.retries, route.action,
+            route.batch_size, route.batch_bytes, route.batch_wait, route.prefetch, executor,
+            limiter, backoff_base, backoff_max, route.raw_json, route.queue, encoding=encoding,
+            dead_letter=dead_letter, rpc=rpc)
+        handler.invoker = invoker
+        subscriptions.extend([(route, handler)] * route.consumers)
+
+    return [
+        RouteListenerThread(
+            rabbit_context, subscriptions[connection_index::num_connections], executor,
+            '{0}-{1}'.format(index, connection_index), partition=partition, dead_letter=dead_letter,
+            readiness=readiness, completed=completed)
+        for connection_index in range(0, num_connections)]
+
+
+def serve(index=0):
+    """run the listener threads in this process"""
     host = getenv('RABBIT_BROKER')
     port = int(getenv('RABBIT_PORT'))
     user = getenv('RABBIT_USER')
     password = getenv('RABBIT_PWD')
     vhost = getenv('RABBIT_VHOST')
     cert = getenv('CERT', 'cert.pem')
-    subscribe = getenv('FEED_QUEUE')
+    routes_table = os.getenv('ROUTES') or None
+    #A routing table takes the place of the single queue and action
+    subscribe = getenv('FEED_QUEUE') if routes_table is None else None
     num_threads = min(int(getenv('RABBIT_CONNECTIONS', '1')), 32)
     timeout_seconds = int(getenv('SUBSCRIBE_TIMEOUT', '3600'))
-    whisk_action = getenv('WHISK_ACTION')
+    whisk_action = getenv('WHISK_ACTION') if routes_table is None else None
     whisk_retries = int(getenv('WHISK_RETRIES', '10'))
+    batch_size = int(getenv('WHISK_BATCH_SIZE', '1'))
+    batch_bytes = int(getenv('WHISK_BATCH_BYTES', str(MAX_PAYLOAD)))
+    batch_wait = int(getenv('WHISK_BATCH_WAIT', '100')) / 1000.0
+    prefetch = max(int(getenv('RABBIT_PREFETCH', '1')), 1)
+    engine = getenv('INVOKER_ENGINE', 'threads')
+    num_workers = int(getenv('WHISK_WORKERS', '0'))
+    work_queue_size = int(getenv('WORK_QUEUE_SIZE', str(max(num_workers, 1) * 2)))
+    max_inflight = int(getenv('WHISK_MAX_INFLIGHT', '0'))
+    backoff_base = int(getenv('WHISK_BACKOFF', '100')) / 1000.0
+    backoff_max = int(getenv('WHISK_BACKOFF_MAX', '30000')) / 1000.0
+    whisk_payload = getenv('WHISK_PAYLOAD', 'string')
+    raw_json = whisk_payload == 'json'
+    metrics_port = int(getenv('METRICS_PORT', '0'))
+    spill_dir = os.getenv('SPILL_DIR') or None
+    spill_max_bytes = int(getenv('SPILL_MAX_MB', '1024')) * 1048576
+    spill_segment_bytes = int(getenv('SPILL_SEGMENT_MB', '64')) * 1048576
+    spill_rate = float(getenv('SPILL_REPLAY_RATE', '100'))
+    use_standby = getenv('RABBIT_STANDBY', 'false') == 'true'
+    partition_spec = os.getenv('PARTITION_KEY') or None
+    whisk_encoding = os.getenv('WHISK_ENCODING') or None
+    dead_letter_exchange = os.getenv('DEAD_LETTER_EXCHANGE') or None
+    retry_delay = int(getenv('RETRY_DELAY', '1000')) / 1000.0
+    retry_delay_max = int(getenv('RETRY_DELAY_MAX', '300000')) / 1000.0
+    concurrency = int(getenv('ASYNC_CONCURRENCY', '256'))
+    autoscale_min = int(getenv('AUTOSCALE_MIN', '1'))
+    autoscale_max = min(int(getenv('AUTOSCALE_MAX', '0')), 32)
+    autoscale_interval = int(getenv('AUTOSCALE_INTERVAL', '10'))
+    autoscale_target = int(getenv('AUTOSCALE_TARGET', '30'))
+    rpc = getenv('WHISK_RPC', 'false') == 'true'
+    idempotency_size = int(getenv('IDEMPOTENCY_SIZE', '0'))
+    idempotency_ttl = int(getenv('IDEMPOTENCY_TTL', '3600'))
+    idempotency_key = getenv('IDEMPOTENCY_KEY', 'message_id')
+    idempotency_file = os.getenv('IDEMPOTENCY_FILE') or None
+    log_async = getenv('LOG_ASYNC', 'false') == 'true'
+    log_queue_size = int(getenv('LOG_QUEUE_SIZE', '10000'))
+    log_summary = int(getenv('LOG_SUMMARY', '0'))
+    log_sample = float(getenv('LOG_SAMPLE', '1'))
+    log_rate = float(getenv('LOG_RATE', '0'))
 
     api_url = getenv('WHISK_URL', None)
     auth_key = getenv('WHISK_AUTH', None)
     namespace = getenv('WHISK_SPACE', None)
 
+    log_writer = None
+    if log_async:
+        #Log records are written by a thread of their own, rather than by the listener threads
+        log_writer = logs.BackgroundWriter(queue_size=log_queue_size)
+        log_writer.start()
+    RESPONSES.configure(log_summary, log_sample, log_rate)
+
     LOGGER.info("Starting...")
     LOGGER.info(" %s, %d, %s, %s, %s.", host, port, user, vhost, subscribe)
 
-    thread_pool = ThreadPoolExecutor(max_workers=num_threads)
+    if rpc and spill_dir is not None:
+        raise Exception("SPILL_DIR is not supported with WHISK_RPC, spilled messages would never be replied to")
+
+    if engine == 'asyncio':
+        #Refuse the settings the asyncio engine would otherwise silently ignore
+        unsupported = [name for name, used in (
+            ('ROUTES', routes_table is not None),
+            ('PARTITION_KEY', partition_spec is not None),
+            ('WHISK_ENCODING', whisk_encoding is not None),
+            ('DEAD_LETTER_EXCHANGE', dead_letter_exchange is not None),
+            ('AUTOSCALE_MAX', autoscale_max > 0),
+            ('WHISK_RPC', rpc),
+            ('IDEMPOTENCY_SIZE', idempotency_size > 0),
+            ('WHISK_BATCH_SIZE', batch_size > 1),
+            ('WHISK_WORKERS', num_workers > 0),
+            ('WHISK_MAX_INFLIGHT', max_inflight > 0),
+            ('WHISK_PAYLOAD', raw_json),
+            ('SPILL_DIR', spill_dir is not None),
+            ('RABBIT_STANDBY', use_standby),
+            ('METRICS_PORT', metrics_port > 0)) if used]
+        if unsupported:
+            raise Exception("{0} not supported by the asyncio engine".format(', '.join(unsupported)))
+
+        #Only needs its (optional) dependencies when selected
+        import async_server
+
+        async_server.RESPONSES.configure(log_summary, log_sample, log_rate)
+        try:
+            async_server.run(
+                whisk.WhiskContext(api_url, auth_key, namespace),
+                rabbitmq.RabbitContext(host, port, user, password, vhost, cert=cert),
+                subscribe, whisk_retries, whisk_action, num_threads, prefetch, concurrency)
+        finally:
+            async_server.RESPONSES.flush()
+            if log_writer is not None:
+                log_writer.stop()
+        return
+
+    routes = None
+    if routes_table is not None:
+        #Settings missing from a route are taken from the environment
+        routes = routing.load_routes(routes_table, {
+            'prefetch': prefetch, 'batch_size': batch_size, 'batch_bytes': batch_bytes,
+            'batch_wait': int(batch_wait * 1000), 'retries': whisk_retries, 'payload': whisk_payload})
+
+        #The routes are consumed over at most RABBIT_CONNECTIONS connections,
+        #and every route is invoked by the shared invoker workers
+        num_threads = min(num_threads, sum(route.consumers for route in routes))
+        if num_workers <= 0:
+            num_workers = sum(route.concurrency() for route in routes)
+            work_queue_size = int(getenv('WORK_QUEUE_SIZE', str(num_workers * 2)))
+        LOGGER.info("Routes: %r", [(route.queue, route.action) for route in routes])
+
+    scaling = autoscale_max > 0
+    if scaling and routes is not None:
+        LOGGER.error("AUTOSCALE_MAX is not supported with ROUTES")
+        scaling = False
+    if scaling:
+        #RABBIT_CONNECTIONS consumers to start with
+        autoscale_min = max(min(autoscale_min, autoscale_max), 1)
+        num_threads = max(min(num_threads, autoscale_max), autoscale_min)
+        LOGGER.info("Autoscaling consumers: %d to %d.", autoscale_min, autoscale_max)
+    max_threads = autoscale_max if scaling else num_threads
+
+    if whisk_encoding is not None:
+        #Fail now, rather than on every message, if the codec is not installed
+        rabbitmq.compress(b'', whisk_encoding)
+
+    dead_letter = None
+    if dead_letter_exchange is not None:
+        #Failed messages are retried from delay queues, up to the retries of their route
+        limits = dict((route.queue, route.retries) for route in routes) if routes is not None else None
+        dead_letter = functools.partial(
+            rabbitmq.RabbitDeadLetter, dead_letter_exchange, whisk_retries, retry_delay, retry_delay_max, limits)
+        LOGGER.info("Dead letter exchange: %r", dead_letter_exchange)
+
+    completed = None
+    if idempotency_size > 0:
+        #Redelivered messages that were handled successfully are acked, not invoked again.
+        #Each listener process remembers the messages of its own connections
+        completed = rabbitmq.RabbitCompleted(
+            idempotency_size, idempotency_ttl, idempotency_key == 'hash',
+            '{0}.{1}'.format(idempotency_file, index) if idempotency_file is not None else None)
+        LOGGER.info("Remembering %d completed messages for %ds, by %s.",
+                    idempotency_size, idempotency_ttl, idempotency_key)
+
+    partition = None
+    if partition_spec is not None:
+        #Each invoker worker is a lane, invoking the messages for its keys in order
+        partition = dispatch.partition_key(partition_spec)
+        if num_workers <= 0:
+            num_workers = 8
+            work_queue_size = int(getenv('WORK_QUEUE_SIZE', str(num_workers * 2)))
+
+    thread_pool = ThreadPoolExecutor(max_workers=max_threads)
+    executor = None
+    threads = {}
+    #Handlers in the order they were started, the most recent are retired first
+    handlers = []
+
+    if num_workers > 0:
+        #Invoker workers are shared by all consumers, so each consumer needs
+        #enough messages in flight to keep its share of the workers busy
+        if partition is not None:
+            executor = dispatch.PartitionedExecutor(num_workers, work_queue_size)
+        else:
+            executor = dispatch.BoundedExecutor(num_workers, work_queue_size)
+        if routes is None:
+            prefetch = max(prefetch, -(-(num_workers + work_queue_size) // num_threads))
+        LOGGER.info("Invoker workers: %d, work queue: %d, prefetch: %d.", num_workers, work_queue_size, prefetch)
+
+    if max_inflight <= 0:
+        #By default the limit only comes into play once invocations are throttled
+        if executor is not None:
+            max_inflight = num_workers
+        elif batch_size > 1:
+            max_inflight = max_threads
+        else:
+            max_inflight = max_threads * prefetch
+
+    limiter = throttle.AdaptiveLimiter(max_inflight)
+
+    #Every RabbitMQ connection, and the OpenWhisk connections of each listener (or route)
+    listener_names = ['{0}-{1}'.format(index, thread_index) for thread_index in range(0, num_threads)]
+    whisk_names = listener_names if routes is None else [route.queue for route in routes]
+    readiness = Readiness(['rabbit-' + name for name in listener_names] + ['whisk-' + name for name in whisk_names])
+
+    def consumers():
+        """The handlers that are not retired"""
+        return [handler for handler in handlers if not handler.retired]
+
+    if metrics_port > 0:
+        metrics.Gauge('rabbitwhisker_consumers', 'Active consumers', function=lambda: len(consumers()))
+        metrics.Gauge('rabbitwhisker_ready', 'Whether every connection opened on start up is ready',
+                      function=lambda: int(readiness.is_ready()))
+        metrics.Gauge('rabbitwhisker_inflight', 'Action invocations in flight', function=lambda: limiter.inflight)
+        metrics.Gauge('rabbitwhisker_inflight_limit', 'Allowed action invocations in flight', function=lambda: int(limiter.limit))
+        if log_writer is not None:
+            metrics.Gauge('rabbitwhisker_log_dropped', 'Log records dropped whilst the log queue was full',
+                          function=lambda: log_writer.dropped)
+        if completed is not None:
+            metrics.Gauge('rabbitwhisker_duplicates', 'Redelivered messages acked without an invocation',
+                          function=lambda: completed.hits)
+        if executor is not None:
+            metrics.Gauge('rabbitwhisker_work_queue', 'Messages waiting for an invoker worker', function=executor.qsize)
+
+        #Each listener process serves its own metrics
+        metrics.start_server(metrics_port + index)
+
+    spill_store = None
+    replayer = None
+    standby = None
+    invoker = None
+    scaler = None
 
     try:
-        threads = {}
         rabbit_context = rabbitmq.RabbitContext(host, port, user, password, vhost, cert=cert)
         whisk_context = whisk.WhiskContext(api_url, auth_key, namespace)
 
-        for _ in range(0, num_threads):
-            handler = MessageHandlerThread(whisk_context, rabbit_context, subscribe, timeout_seconds, whisk_retries, whisk_action)
-            future = thread_pool.submit(handler.listen)
-            threads[future] = handler
+        if routes is not None:
+            if spill_dir is not None or use_standby:
+                LOGGER.error("SPILL_DIR and RABBIT_STANDBY are not supported with ROUTES")
+
+            #One HTTP connection pool is shared by every route
+            invoker = whisk.WhiskInvoker(whisk_context, pool_size=num_workers, **rpc_params(rpc))
+            for listener in route_listeners(
+                    routes, invoker, whisk_context, rabbit_context, num_threads, timeout_seconds,
+                    executor, limiter, backoff_base, backoff_max, index, partition, whisk_encoding, dead_letter,
+                    readiness, rpc, completed):
+                future = thread_pool.submit(listener.listen)
+                threads[future] = listener
+
+            #Open the connections for each action whilst connecting to RabbitMQ
+            for route in routes:
+                threading.Thread(
+                    target=preconnect, args=(invoker, route.action, route.concurrency(), readiness, 'whisk-' + route.queue),
+                    name='whisk-' + route.queue, daemon=True).start()
+        else:
+            if use_standby:
+                #One connection in reserve, for whichever listener loses its connection first
+                standby = rabbitmq.RabbitStandby(rabbit_context, functools.partial(rabbitmq.RabbitClient, connection_attempts=1))
+
+            if spill_dir is not None:
+                #Each listener process has a store of its own
+                spill_store = spill.SpillStore(os.path.join(spill_dir, str(index)), spill_max_bytes, spill_segment_bytes)
+                replayer = spill.SpillReplayer(
+                    spill_store, whisk_context, whisk_action, spill_rate, batch_size, raw_json, whisk_encoding)
+                threading.Thread(target=replayer.run, name='replayer', daemon=True).start()
+
+            thread_numbers = itertools.count()
+
+            def start_handler():
+                handler = MessageHandlerThread(
+                    whisk_context, rabbit_context, subscribe, timeout_seconds, whisk_retries, whisk_action,
+                    batch_size, batch_bytes, batch_wait, prefetch, executor,
+                    limiter, backoff_base, backoff_max, raw_json, '{0}-{1}'.format(index, next(thread_numbers)),
+                    spill_store=spill_store, standby=standby, partition=partition, encoding=whisk_encoding,
+                    dead_letter=dead_letter, readiness=readiness, rpc=rpc, completed=completed)
+                future = thread_pool.submit(handler.listen)
+                threads[future] = handler
+                handlers.append(handler)
+
+            for _ in range(0, num_threads):
+                start_handler()
 
+            if scaling:
+                #Consumers are busy with as many invocations as they may have in flight,
+                #or, with invoker workers, when the workers are
+                capacity = 1 if batch_size > 1 else prefetch
+
+                def utilization():
+                    if executor is not None:
+                        return limiter.inflight / float(num_workers)
+                    return limiter.inflight / float(max(len(consumers()) * capacity, 1))
+
+                scaler = autoscale.Autoscaler(
+                    autoscale.QueueDepthProbe(rabbit_context, subscribe), MESSAGES.total, utilization,
+                    autoscale_min, autoscale_max, autoscale_target)
+                if metrics_port > 0:
+                    metrics.Gauge('rabbitwhisker_queue_depth', 'Messages ready in the queue, when autoscaling',
+                                  function=lambda: scaler.depth or 0)
+
+        next_sample = time.monotonic() + autoscale_interval
         while True:
             try:
-                stopped_threads, running_threads = wait(threads, timeout=3600, return_when=FIRST_COMPLETED)
-                LOGGER.info("Running threads: %r, Stopped threads: %r", len(running_threads), len(stopped_threads))
+                stopped_threads, running_threads = wait(
+                    threads, timeout=autoscale_interval if scaler is not None else 3600, return_when=FIRST_COMPLETED)
+                if stopped_threads or scaler is None:
+                    LOGGER.info("Running threads: %r, Stopped threads: %r", len(running_threads), len(stopped_threads))
 
                 # Ordinarily, a thread should never finish; if one has, remove it and start replacement thread.
                 for stopped_thread in stopped_threads:
+                    handler = threads.pop(stopped_thread)
+                    if getattr(handler, 'retired', False):
+                        LOGGER.info("Consumer %r retired.", handler.name)
+                        handlers.remove(handler)
+                        continue
                     LOGGER.error("Thread stopped; starting replacement...")
-                    handler = threads[stopped_thread]
                     future = thread_pool.submit(handler.listen)
                     threads[future] = handler
-                    del threads[stopped_thread]
+
+                if scaler is not None and time.monotonic() >= next_sample:
+                    next_sample = time.monotonic() + autoscale_interval
+                    active = consumers()
+                    wanted = scaler.sample(len(active))
+                    for _ in range(len(active), wanted):
+                        start_handler()
+                    for handler in active[wanted:]:
+                        handler.retire()
             except KeyboardInterrupt:
                 break
             except Exception as expt:
@@ -236,9 +1022,34 @@ def main():
         for future, handler in threads.items():
             handler.stop()
 
+        #The listeners wait for their outstanding messages, which need the executor
         thread_pool.shutdown()
+
+        if executor is not None:
+            executor.shutdown()
+
+        if invoker is not None:
+            invoker.close()
+
+        if scaler is not None:
+            scaler.probe.close()
+
+        if standby is not None:
+            standby.stop()
+
+        if completed is not None:
+            completed.save()
+
+        if replayer is not None:
+            replayer.stop()
+            spill_store.close()
+
+        RESPONSES.flush()
         LOGGER.info("Stopped.")
 
+        if log_writer is not None:
+            log_writer.stop()
+
 
 if __name__ == '__main__':
     main()
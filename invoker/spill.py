@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Durable on-disk buffer for messages whilst the action cannot be invoked.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import os
+import zlib
+import struct
+import functools
+import logging
+import threading
+
+import whisk
+import payload
+import throttle
+
+LOGGER = logging.getLogger(__package__)
+
+#Each record is the length and CRC32 of the message body, then the body
+RECORD = struct.Struct('>II')
+
+CHECKPOINT = 'replay.offset'
+
+
+class SpillStore:
+    """
+        An append only log of message bodies, split into segment files. Appends
+        are synced to disk before returning, and the replay position is kept in
+        a checkpoint file, so messages survive a crash of the listener.
+        A partly written record at the end of the log is discarded on start up
+    """
+    def __init__(self, directory, max_bytes=1073741824, segment_bytes=67108864):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+
+        #Set whilst the action cannot be invoked, cleared once a replay succeeds
+        self.outage = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.read_segment, self.read_offset = self.load_checkpoint()
+
+        self.segments = sorted(
+            int(name[8:-4]) for name in os.listdir(directory)
+            if name.startswith('segment-') and name.endswith('.log'))
+
+        #Segments before the checkpoint have already been replayed
+        for segment in [segment for segment in self.segments if segment < self.read_segment]:
+            os.remove(self.path(segment))
+            self.segments.remove(segment)
+
+        if not self.segments:
+            self.segments.append(self.read_segment)
+            self.read_offset = 0
+        elif self.read_segment not in self.segments:
+            self.read_segment, self.read_offset = self.segments[0], 0
+
+        self.write_segment = self.segments[-1]
+        self.write_offset = self.recover(self.write_segment)
+        self.writer = open(self.path(self.write_segment), 'ab')
+        self.size = sum(os.path.getsize(self.path(segment)) for segment in self.segments)
+
+        if self.pending():
+            LOGGER.info("Spill store holds %d bytes to replay", self.size)
+
+    def path(self, segment):
+        return os.path.join(self.directory, 'segment-{0:012d}.log'.format(segment))
+
+    def load_checkpoint(self):
+        """
+            Reads the replay position
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                A (segment, offset) tuple
+        """
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as checkpoint:
+                segment, offset = checkpoint.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def recover(self, segment):
+        """
+            Truncates a segment after its last complete, uncorrupted record
+
+            Throws:
+                OSError if the segment cannot be read
+
+            Returns:
+                The length of the segment
+        """
+        path = self.path(segment)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+            return 0
+
+        offset = 0
+        with open(path, 'rb+') as log:
+            data = log.read()
+            while offset + RECORD.size <= len(data):
+                length, crc = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + length
+                if end > len(data) or zlib.crc32(data[offset + RECORD.size:end]) != crc:
+                    break
+                offset = end
+
+            if offset < len(data):
+                LOGGER.error("Spill store discarding %d bytes of a partly written record", len(data) - offset)
+                log.truncate(offset)
+
+        return offset
+
+    def pending(self):
+        """Whether there are messages waiting to be replayed"""
+        with self.lock:
+            return (self.read_segment, self.read_offset) < (self.write_segment, self.write_offset)
+
+    def append(self, bodies):
+        """
+            Durably appends message bodies to the log
+
+            Throws:
+                OSError if the log cannot be written
+
+            Returns:
+                True if the bodies were stored, False if the store is full
+        """
+        data = b''.join(RECORD.pack(len(body), zlib.crc32(body)) + bytes(body) for body in bodies)
+
+        with self.lock:
+            if self.size + len(data) > self.max_bytes:
+                return False
+
+            if self.write_offset > 0 and self.write_offset + len(data) > self.segment_bytes:
+                self.writer.close()
+                self.write_segment += 1
+                self.write_offset = 0
+                self.segments.append(self.write_segment)
+                self.writer = open(self.path(self.write_segment), 'ab')
+
+            self.writer.write(data)
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+
+            self.write_offset += len(data)
+            self.size += len(data)
+            return True
+
+    def read(self, max_records, max_bytes, measure=len):
+        """
+            Reads the next message bodies to replay, without consuming them, up
+            to max_bytes of them as counted by measure
+
+            Throws:
+                OSError if the log cannot be read
+
+            Returns:
+                A list of bodies, and the position to commit once they are replayed
+        """
+        with self.lock:
+            segment, offset = self.read_segment, self.read_offset
+            #Move on from a segment that has been fully replayed
+            if segment < self.write_segment and offset >= os.path.getsize(self.path(segment)):
+                segment, offset = self.segments[self.segments.index(segment) + 1], 0
+            end = self.write_offset if segment == self.write_segment else os.path.getsize(self.path(segment))
+
+        bodies = []
+        size = 0
+        with open(self.path(segment), 'rb') as log:
+            log.seek(offset)
+            while offset < end and len(bodies) < max_records:
+                length, _ = RECORD.unpack(log.read(RECORD.size))
+                body = log.read(length)
+                body_size = measure(body)
+                if bodies and size + body_size > max_bytes:
+                    break
+                bodies.append(body)
+                size += body_size
+                offset += RECORD.size + length
+
+        return bodies, (segment, offset)
+
+    def commit(self, position):
+        """
+            Records that messages up to position have been replayed, removing
+            segments that are no longer needed
+
+            Throws:
+                OSError if the checkpoint cannot be written
+
+            Returns:
+                Nothing
+        """
+        with self.lock:
+            self.read_segment, self.read_offset = position
+
+            temp = os.path.join(self.directory, CHECKPOINT + '.tmp')
+            with open(temp, 'w') as checkpoint:
+                checkpoint.write('{0} {1}'.format(*position))
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            os.replace(temp, os.path.join(self.directory, CHECKPOINT))
+
+            for segment in [segment for segment in self.segments if segment < self.read_segment]:
+                self.size -= os.path.getsize(self.path(segment))
+                os.remove(self.path(segment))
+                self.segments.remove(segment)
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+
+class SpillReplayer:
+    """Invokes the action with spilled messages, at a controlled rate"""
+    def __init__(self, store, whisk_context, action, rate, batch_size=1, raw_json=False, encoding=None):
+        self.store = store
+        self.whisk_context = whisk_context
+        self.action = action
+        self.rate = rate
+        self.batch_size = batch_size
+        self.raw_json = raw_json
+        self.encoding = encoding
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        """
+            A thread, that replays spilled messages until stopped
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        retry = 0
+
+        with whisk.WhiskInvoker(self.whisk_context) as invoker:
+            while not self.stopping.is_set():
+                try:
+                    bodies, position = self.store.read(
+                        self.batch_size, payload.MAX_PAYLOAD - payload.OVERHEAD,
+                        functools.partial(payload.encoded_size, raw_json=self.raw_json))
+                    if not bodies:
+                        self.stopping.wait(1)
+                        continue
+
+                    try:
+                        json_msg = payload.build(bodies, self.raw_json)
+                        if self.encoding is not None:
+                            json_msg = payload.compress(json_msg, self.encoding)
+                    except Exception as expt:
+                        LOGGER.error("Spill store dropping %d messages: %r", len(bodies), expt)
+                        self.store.commit(position)
+                        continue
+
+                    status, result = invoker.post(json_msg, self.action)
+                    if 'error' in result and whisk.is_permanent(status):
+                        #Replaying these again would fail in the same way, and hold up the rest
+                        LOGGER.error("Spill store dropping %d messages, HTTP %r: %r", len(bodies), status, result)
+                        #The action could be invoked, new messages need not be spilled
+                        self.store.outage = False
+                        self.store.commit(position)
+                        continue
+
+                    if 'error' in result:
+                        retry += 1
+                        self.stopping.wait(throttle.backoff(min(retry, 10), 0.5, 60.0))
+                        continue
+
+                    retry = 0
+                    self.store.outage = False
+                    self.store.commit(position)
+                    LOGGER.info("Replayed %d messages: %r", len(bodies), result)
+
+                    if self.rate > 0:
+                        self.stopping.wait(len(bodies) / self.rate)
+                except Exception as expt:
+                    LOGGER.error("Replay Exception: %r", expt)
+                    self.stopping.wait(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Offline listener start up benchmark.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+import multiprocessing
+
+from messenger import rabbitmq
+
+import server
+import whisk
+import benchmark
+
+LOGGER = logging.getLogger(__package__)
+
+#Run in a fresh interpreter, so nothing is imported already
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import server
+print(time.perf_counter() - start, 'requests' in sys.modules)
+'''
+
+
+class SlowMemoryClient(benchmark.MemoryClient):
+    """A MemoryClient that takes a while to connect, as a RabbitMQ service would"""
+    def __init__(self, context, broker, delay):
+        self.delay = delay
+        super(SlowMemoryClient, self).__init__(context, broker)
+
+    def connect(self, connection_attempts, retry_delay):
+        time.sleep(self.delay)
+        super(SlowMemoryClient, self).connect(connection_attempts, retry_delay)
+
+
+def measure_imports(repeats):
+    """
+        Times importing the listener in a fresh interpreter
+
+        Throws:
+            An exception if the listener cannot be imported
+
+        Returns:
+            A dict of results
+    """
+    seconds = []
+    for _ in range(0, repeats):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT]).decode().split()
+        seconds.append(float(output[0]))
+    return {'phase': 'imports', 'import_ms': round(min(seconds) * 1000, 1), 'requests_imported': output[1] == 'True'}
+
+
+def measure_ssl(cert, connections):
+    """
+        Times creating an SSL context for each of the connections, as pika does,
+        against sharing one context between them
+
+        Throws:
+            An exception if the certificate cannot be loaded
+
+        Returns:
+            A dict of results
+    """
+    start = time.perf_counter()
+    for _ in range(0, connections):
+        rabbitmq.ssl.SSLContext(rabbitmq.ssl.PROTOCOL_TLSv1_2).load_verify_locations(cert)
+    separate = time.perf_counter() - start
+
+    rabbitmq.SSL_CONTEXTS.clear()
+    start = time.perf_counter()
+    for _ in range(0, connections):
+        rabbitmq.ssl_context(ca_certs=cert, cert_reqs=rabbitmq.ssl.CERT_REQUIRED)
+    shared = time.perf_counter() - start
+
+    return {'phase': 'ssl', 'connections': connections,
+            'separate_ms': round(separate * 1000, 2), 'shared_ms': round(shared * 1000, 2)}
+
+
+def measure_ready(whisk_context, args, connections):
+    """
+        Times starting connections listeners, until every RabbitMQ and
+        OpenWhisk connection is ready
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            A dict of results
+    """
+    broker = benchmark.MemoryBroker()
+    rabbit_context = rabbitmq.RabbitContext('memory', 0, 'bench', 'bench', '/', ssl=False)
+    delay = args.connect_ms / 1000.0
+    server.SHUTTING_DOWN = False
+
+    names = [str(index) for index in range(0, connections)]
+    readiness = server.Readiness(['rabbit-' + name for name in names] + ['whisk-' + name for name in names])
+    handlers = []
+    for name in names:
+        handler = server.MessageHandlerThread(
+            whisk_context, rabbit_context, 'bench', 5, 1, 'bench', prefetch=args.prefetch, name=name,
+            client_factory=lambda context: SlowMemoryClient(context, broker, delay), readiness=readiness)
+        handlers.append((handler, server.threading.Thread(target=handler.listen, daemon=True)))
+
+    for _, thread in handlers:
+        thread.start()
+    ready = readiness.wait(args.timeout)
+
+    server.SHUTTING_DOWN = True
+    for handler, thread in handlers:
+        if handler.rabbit is not None:
+            handler.stop()
+        thread.join(timeout=10)
+
+    return {'phase': 'ready', 'connections': connections, 'prefetch': args.prefetch,
+            'connect_ms': args.connect_ms, 'handshake_ms': args.handshake_ms,
+            'ready_ms': round(readiness.seconds * 1000, 1) if ready else None,
+            #Each listener connecting to RabbitMQ then OpenWhisk, one after the other
+            'serial_ms': round(args.connect_ms + args.handshake_ms, 1)}
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description='Offline listener start up benchmark')
+    parser.add_argument('--connections', type=benchmark.int_list, default=[1, 4, 16], help='listener connections')
+    parser.add_argument('--prefetch', type=int, default=4, help='OpenWhisk connections per listener')
+    parser.add_argument('--connect-ms', type=float, default=100, help='time taken to connect to RabbitMQ')
+    parser.add_argument('--handshake-ms', type=float, default=100, help='time taken to open an OpenWhisk connection')
+    parser.add_argument('--imports', type=int, default=5, help='times to import the listener, the fastest is reported')
+    parser.add_argument('--cert', help='certificate to load, to compare SSL context creation')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds allowed per run')
+    parser.add_argument('--output', help='file for the JSON lines results, default stdout')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    ports = multiprocessing.Queue()
+    action = multiprocessing.Process(
+        target=benchmark.serve_action, args=(ports, args.handshake_ms / 1000.0, 0), daemon=True)
+    action.start()
+    whisk_context = whisk.WhiskContext('http://127.0.0.1:{0}'.format(ports.get(timeout=10)), 'bench:bench', 'bench')
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        results = [measure_imports(args.imports)]
+        if args.cert is not None:
+            results.extend(measure_ssl(args.cert, connections) for connections in args.connections)
+        results.extend(measure_ready(whisk_context, args, connections) for connections in args.connections)
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        action.terminate()
+
+
+if __name__ == '__main__':
+    main()
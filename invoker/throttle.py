@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#author markpurcell@ie.ibm.com
+
+"""Adaptive limit on in-flight Cloud Function invocations.
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import time
+import random
+import logging
+import threading
+
+LOGGER = logging.getLogger(__package__)
+
+
+def backoff(retry, base=0.1, cap=30.0):
+    """
+        Delay before the next attempt, exponential in the number of retries
+        so far with full jitter, so that threads do not retry in lockstep
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            The delay in seconds
+    """
+    return random.uniform(0, min(cap, base * (2 ** retry)))
+
+
+def is_throttled(status):
+    """
+        Whether an invocation response shows that the platform is overloaded;
+        too many requests, a server error, or no response at all
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            True if the response was throttled
+    """
+    return status is None or status == 429 or status >= 500
+
+
+class AdaptiveLimiter:
+    """
+        Limits the number of in-flight invocations across all threads, using
+        additive increase / multiplicative decrease. The limit is halved when
+        invocations are throttled, eased down when latency grows well beyond
+        the best seen, and otherwise grows by about one per round of invocations
+    """
+    def __init__(self, max_limit, min_limit=1, decrease=0.5, tolerance=2.0):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.limit = float(self.max_limit)
+        self.inflight = 0
+        self.min_latency = None
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+            Waits until another invocation is allowed
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                True if the invocation may proceed, False if timed out
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.inflight < int(self.limit), timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, throttled, latency):
+        """
+            Records the outcome of an invocation and adjusts the limit
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        with self.condition:
+            self.inflight -= 1
+            now = time.monotonic()
+
+            if throttled:
+                #Invocations already in flight will see the same throttling,
+                #so only decrease once per round trip
+                if now - self.last_decrease > (self.min_latency or 0):
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+                    LOGGER.info("Throttled, in-flight limit now %d", int(self.limit))
+            else:
+                #Let the baseline drift upwards slowly, in case the best latency was a fluke
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                else:
+                    self.min_latency *= 1.001
+
+                if latency > self.tolerance * self.min_latency:
+                    self.limit = max(self.min_limit, self.limit - 1.0 / self.limit)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            self.condition.notify()
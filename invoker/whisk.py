@@ -21,7 +21,41 @@
 """
 
 import json
-import requests
+import threading
+
+#Responses that will not change however often the invocation is retried;
+#a bad request, no such action, a payload that is too large, or unprocessable
+PERMANENT_STATUSES = (400, 404, 413, 422)
+
+
+def is_permanent(status):
+    """
+        Whether an invocation response shows that invoking the action again
+        with the same payload would fail in the same way
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            True if the failure is permanent
+    """
+    return status in PERMANENT_STATUSES
+
+
+def is_action_error(status, result):
+    """
+        Whether the response to a blocking invocation for its result carries
+        the error result of the action itself, rather than a failure to invoke
+        it. Openwhisk answers with a 502 in both cases, but its own errors
+        carry a code
+
+        Throws:
+            No exceptions thrown
+
+        Returns:
+            True if the action ran and failed
+    """
+    return status == 502 and isinstance(result, dict) and 'error' in result and 'code' not in result
 
 
 class WhiskContext:
@@ -33,9 +67,10 @@ class WhiskContext:
 
 class WhiskInvoker:
     """WhiskInvoker"""
-    def __init__(self, context, blocking='false', result='false'):
+    def __init__(self, context, blocking='false', result='false', pool_size=10):
         self.context = context
         self.params = {'blocking': blocking, 'result': result}
+        self.pool_size = pool_size
         self.start()
 
     def __enter__(self):
@@ -54,8 +89,15 @@ class WhiskInvoker:
             Returns:
                 Nonee
         """
+        #Deferred until needed, requests takes a while to import
+        import requests
+        from requests.adapters import HTTPAdapter
 
         self.session = requests.Session()
+        #Allow one pooled connection per concurrent invocation
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.session.auth = (self.context.user_pass[0], self.context.user_pass[1])
         self.session.headers.update({'content-type': 'application/json'})
 
@@ -71,6 +113,34 @@ class WhiskInvoker:
         """
         self.session.close()
 
+    def preconnect(self, action, connections=1, timeout=5):
+        """
+            Opens pooled connections to Openwhisk in parallel, ahead of the first
+            invocation of the action, so that messages do not wait on the handshakes
+
+            Throws:
+                No exception thrown
+
+            Returns:
+                The number of connections opened
+        """
+        opened = []
+
+        def head():
+            try:
+                self.session.head(self.context.url + action, timeout=timeout)
+                opened.append(True)
+            except Exception:
+                #The invocations will report the problem
+                pass
+
+        threads = [threading.Thread(target=head, daemon=True) for _ in range(0, max(min(connections, self.pool_size), 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(opened)
+
     def invoke(self, json_msg, action):
         """
             Invokes an Openwhisk action, catching all exceptions
@@ -81,6 +151,19 @@ class WhiskInvoker:
             Returns:
                 The response from Openwhisk, or a dict containing an error
         """
+        return self.post(json_msg, action)[1]
+
+    def post(self, json_msg, action):
+        """
+            Invokes an Openwhisk action, catching all exceptions
+
+            Throws:
+                No exception thrown
+
+            Returns:
+                A tuple of the HTTP status code (None if there was no response)
+                and the response from Openwhisk, or a dict containing an error
+        """
 
         try:
             response = self.session.post(self.context.url + action, data=json_msg, params=self.params)
@@ -88,10 +171,16 @@ class WhiskInvoker:
             #Something went wrong - could be a general error
             #or under high load, too many in-flight activations
             #Retry policy is the responsibility of the caller
-            self.close()
-            self.start()
-            return {'error': str(expt)}
+            #The session discards a broken connection itself, so the
+            #remaining pooled connections are kept
+            return None, {'error': str(expt)}
 
         # It's possible that the OW action is not available
         # in which case there will be an "error" entry in the response dict
-        return json.loads(response.text)
+        try:
+            return response.status_code, json.loads(response.text)
+        except ValueError:
+            #A gateway in front of Openwhisk may answer with an HTML page, given a
+            #code like the errors of Openwhisk itself, see is_action_error
+            return response.status_code, {
+                'error': 'HTTP {0}: {1}'.format(response.status_code, response.text[:200]), 'code': None}
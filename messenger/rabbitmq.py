@@ -20,11 +20,183 @@
  */
 """
 
+import os
 import ssl
+import copy
+import time
+import hashlib
+import socket
+import zlib
+import random
+import logging
+import functools
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 import pika
 
+#Faster codecs are used when they are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+LOGGER = logging.getLogger(__package__)
+
+
+def compress(body, encoding):
+    """
+        Compresses a message body with a content encoding, 'deflate' (zlib),
+        'zstd' or 'lz4'
+
+        Throws:
+            ValueError if the encoding is not supported (or not installed)
+
+        Returns:
+            The compressed body
+    """
+    if encoding == 'deflate':
+        return zlib.compress(body)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(body)
+    if encoding == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(body)
+    raise ValueError("Unsupported content encoding: {0!r}".format(encoding))
+
+
+def decompress(body, encoding):
+    """
+        Decompresses a message body with its content encoding
+
+        Throws:
+            ValueError if the encoding is not supported (or not installed),
+            otherwise an exception if the body is not valid
+
+        Returns:
+            The decompressed body
+    """
+    if encoding == 'deflate':
+        return zlib.decompress(body)
+    if encoding == 'zstd' and zstandard is not None:
+        #Unlike decompress, copes with frames that do not record their size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    if encoding == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(body)
+    raise ValueError("Unsupported content encoding: {0!r}".format(encoding))
+
+
+def decode(body, encoding):
+    """
+        Decompresses a consumed message body if it has a content encoding that
+        can be decompressed, otherwise passes the body through unchanged
+
+        Throws:
+            An exception if the body is not valid for its content encoding
+
+        Returns:
+            The body
+    """
+    if not can_decompress(encoding):
+        return body
+    return decompress(body, encoding)
+
+
+def can_decompress(encoding):
+    """Whether bodies with the content encoding are decompressed on consume"""
+    return (encoding == 'deflate' or (encoding == 'zstd' and zstandard is not None) or
+            (encoding == 'lz4' and lz4 is not None))
+
+
+def best_encoding():
+    """The fastest content encoding that is installed"""
+    if zstandard is not None:
+        return 'zstd'
+    if lz4 is not None:
+        return 'lz4'
+    return 'deflate'
+
+
+#Resolved broker addresses and SSL contexts, shared by every connection in the process
+ADDRESSES = {}
+ADDRESS_TTL = 300
+SSL_CONTEXTS = {}
+SSL_CONTEXTS_LOCK = threading.Lock()
+
+
+def resolve(host, port):
+    """
+        Resolves the host name of a service, caching the address for ADDRESS_TTL
+        seconds, so that connecting (and reconnecting) does not wait on DNS
+
+        Throws:
+            Nothing
+
+        Returns:
+            The address, or the host name if it cannot be resolved
+    """
+    now = time.monotonic()
+    cached = ADDRESSES.get((host, port))
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    try:
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM, socket.IPPROTO_TCP)[0][4][0]
+    except (socket.error, IndexError):
+        #Let the connection attempt report the failure
+        return host
+
+    ADDRESSES[(host, port)] = (address, now + ADDRESS_TTL)
+    return address
+
+
+def forget(host, port):
+    """Discards the cached address of a service, it is resolved again on the next connection"""
+    ADDRESSES.pop((host, port), None)
+
+
+def ssl_context(ssl_version=ssl.PROTOCOL_TLSv1_2, ca_certs=None, cert_reqs=ssl.CERT_NONE):
+    """
+        Returns the SSL context for the options, creating it on first use, so that
+        the certificate is loaded once rather than for every connection
+
+        Throws:
+            An exception if the certificate cannot be loaded
+
+        Returns:
+            An ssl.SSLContext
+    """
+    key = (ssl_version, ca_certs, cert_reqs)
+    with SSL_CONTEXTS_LOCK:
+        context = SSL_CONTEXTS.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl_version)
+            #As with ssl.wrap_socket, the certificate is verified but not the host name
+            context.check_hostname = False
+            context.verify_mode = cert_reqs
+            if ca_certs is not None:
+                context.load_verify_locations(ca_certs)
+            SSL_CONTEXTS[key] = context
+        return context
+
+
+class SharedContextConnection(pika.SelectConnection):
+    """
+        A pika connection that wraps its socket with the shared SSL context for its
+        options, rather than creating (and loading the certificate into) a new one
+    """
+    def _wrap_socket(self, sock):
+        options = dict(self.params.ssl_options or {})
+        server_hostname = options.pop('server_hostname', None)
+        return ssl_context(**options).wrap_socket(
+            sock, do_handshake_on_connect=self.DO_HANDSHAKE, server_hostname=server_hostname)
+
 
 class RabbitContext():
     """
@@ -39,6 +211,16 @@ class RabbitContext():
         self.ssl = ssl
         self.cert = cert
 
+    def __eq__(self, other):
+        return isinstance(other, RabbitContext) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        """The connection details, identifying the service"""
+        return (self.host, self.port, self.user, self.pwd, self.vhost, self.ssl, self.cert)
+
 
 class RabbitQueue():
     """
@@ -52,6 +234,337 @@ class RabbitQueue():
         self.purge = purge
 
 
+class RabbitDelivery():
+    """
+        A message consumed from a queue, which the consumer acks, nacks or
+        rejects. These must be called on the thread that owns the connection,
+        see RabbitMessenger.call_threadsafe
+    """
+    __slots__ = ('channel', 'delivery_tag', 'redelivered', 'exchange', 'routing_key', 'properties', 'body')
+
+    def __init__(self, channel, method_frame, properties, body):
+        self.channel = channel
+        self.delivery_tag = method_frame.delivery_tag
+        self.redelivered = method_frame.redelivered
+        self.exchange = method_frame.exchange
+        self.routing_key = method_frame.routing_key
+        self.properties = properties
+        #A view of the (decompressed) body, so slicing it does not copy it
+        self.body = memoryview(body)
+
+    @property
+    def headers(self):
+        """The message headers, empty if there are none"""
+        return self.properties.headers or {}
+
+    def ack(self, multiple=False):
+        """Acknowledges the message, and with multiple every earlier unacknowledged message"""
+        self.channel.basic_ack(self.delivery_tag, multiple=multiple)
+
+    def nack(self, multiple=False, requeue=True):
+        """Returns the message to the queue, and with multiple every earlier unacknowledged message"""
+        self.channel.basic_nack(self.delivery_tag, multiple=multiple, requeue=requeue)
+
+    def reject(self, requeue=False):
+        """Rejects the message, which is discarded (or dead lettered) unless requeued"""
+        self.channel.basic_reject(self.delivery_tag, requeue=requeue)
+
+
+class RabbitFailure():
+    """
+        Returned by a handler that could not deal with a message. A permanent
+        failure will recur however often the message is handled
+    """
+    __slots__ = ('reason', 'permanent', 'status', 'encoded')
+
+    def __init__(self, reason, permanent=False, status=None, encoded=False):
+        self.reason = reason
+        self.permanent = permanent
+        self.status = status
+        #The body could not be decompressed, so keeps its content encoding
+        self.encoded = encoded
+
+    def __repr__(self):
+        return 'RabbitFailure({0!r}, permanent={1!r}, status={2!r})'.format(self.reason, self.permanent, self.status)
+
+
+class RabbitReply():
+    """
+        Returned by a handler that dealt with its messages, holding a reply body
+        for each message. Each reply is published to the queue named by the
+        reply_to property of its message, with the message's correlation_id
+    """
+    __slots__ = ('replies', 'content_type')
+
+    def __init__(self, replies, content_type=None):
+        self.replies = replies
+        self.content_type = content_type
+
+    def __repr__(self):
+        return 'RabbitReply({0!r} replies)'.format(len(self.replies))
+
+
+class RabbitDeadLetter():
+    """
+        Takes messages whose handler failed off the queue. A message that failed
+        permanently, or has already been retried max_retries times, is published
+        to a dead letter exchange, with headers describing the failure. Any other
+        message is retried later: it waits in a delay queue, whose messages expire
+        back onto the original queue. Delays double with each retry, from
+        delay_base up to delay_max seconds, and each delay has a queue of its own,
+        so that messages expire in order. limits may give other max_retries for
+        particular queues. Holds a channel of a connection, so each connection
+        needs its own RabbitDeadLetter
+    """
+    def __init__(self, exchange, max_retries=10, delay_base=1.0, delay_max=300.0, limits=None):
+        self.exchange = exchange
+        self.max_retries = max_retries
+        self.limits = limits or {}
+        self.delay_base = delay_base
+        self.delay_max = delay_max
+        self.channel = None
+        self.declared = set()
+
+    def open(self, connection):
+        """
+            Opens a channel in confirm mode, so a message is only acked once the
+            broker has its copy, and declares the dead letter exchange (a durable
+            topic exchange, the routing key being the original queue name)
+
+            Throws:
+                Exception if the exchange exists with other settings
+
+            Returns:
+                The channel
+        """
+        if self.channel is None or not self.channel.is_open:
+            self.channel = connection.channel()
+            self.channel.confirm_delivery()
+            self.channel.exchange_declare(exchange=self.exchange, exchange_type='topic', durable=True)
+            self.declared = set()
+        return self.channel
+
+    def delay_queue(self, queue, delay):
+        """
+            Declares the delay queue for a queue and delay (in milliseconds)
+
+            Throws:
+                Exception if the queue cannot be declared
+
+            Returns:
+                The name of the delay queue
+        """
+        name = '{0}.retry.{1}'.format(queue, delay)
+        if name not in self.declared:
+            self.channel.queue_declare(queue=name, durable=True, arguments={
+                'x-message-ttl': delay,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue})
+            self.declared.add(name)
+        return name
+
+    def route(self, connection, queue, properties, body, failure):
+        """
+            Publishes a failed message to a delay queue or the dead letter exchange.
+            Must run on the thread that owns the connection
+
+            Throws:
+                UnroutableError if no queue is bound for the message
+                Exception if the broker does not accept the message
+
+            Returns:
+                True if the message was dead lettered, False if it will be retried
+        """
+        channel = self.open(connection)
+        headers = dict(properties.headers or {})
+        retries = headers.get('x-retries', 0)
+
+        #The body was decompressed when it was consumed, unless that failed
+        encoding = properties.content_encoding
+        if can_decompress(encoding) and not failure.encoded:
+            encoding = None
+
+        if not failure.permanent and retries < self.limits.get(queue, self.max_retries):
+            headers['x-retries'] = retries + 1
+            delay = int(min(self.delay_base * (2 ** retries), self.delay_max) * 1000)
+            exchange, routing_key = '', self.delay_queue(queue, delay)
+        else:
+            headers.update({
+                'x-retries': retries,
+                'x-error': str(failure.reason)[:1000],
+                'x-error-status': failure.status if failure.status is not None else 0,
+                'x-error-permanent': failure.permanent,
+                'x-original-queue': queue,
+                'x-failed-at': int(time.time())})
+            exchange, routing_key = self.exchange, queue
+
+        #Mandatory, so a message the exchange has no queue for is returned
+        #(raising UnroutableError) rather than silently dropped
+        channel.publish(exchange, routing_key, bytes(body), pika.BasicProperties(
+            content_type=properties.content_type, content_encoding=encoding, headers=headers,
+            delivery_mode=2, correlation_id=properties.correlation_id, reply_to=properties.reply_to,
+            message_id=properties.message_id, timestamp=properties.timestamp, type=properties.type,
+            app_id=properties.app_id), mandatory=True)
+        return exchange == self.exchange
+
+
+class RabbitCompleted():
+    """
+        Remembers the messages handled successfully, so one redelivered by the
+        broker is acked without being handled again. A message is known by its
+        message_id or, with hash_bodies, by a hash of its body if it has none.
+        Up to capacity messages are remembered, the least recently seen are
+        forgotten first, each for at most ttl seconds. It may be shared by the
+        connections of a process and, with a path, saved to that file every
+        save_interval seconds and loaded again on start up
+    """
+    def __init__(self, capacity=10000, ttl=3600, hash_bodies=False, path=None, save_interval=5):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hash_bodies = hash_bodies
+        self.path = path
+        self.save_interval = save_interval
+        #Key to expiry time, least recently seen first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.saved = time.monotonic()
+        self.hits = 0
+        if path is not None:
+            self.load()
+
+    def key(self, properties, body):
+        """
+            The key a message is remembered by
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                The key, or None if the message cannot be recognised
+        """
+        if properties.message_id:
+            return 'id:' + str(properties.message_id)
+        if self.hash_bodies:
+            return 'sha1:' + hashlib.sha1(body).hexdigest()
+        return None
+
+    def seen(self, properties, body, redelivered=True):
+        """
+            Checks if a message was handled successfully within the last ttl
+            seconds. A message without a message_id is only recognised by the
+            hash of its body when it is redelivered, since separate messages
+            may well have the same body
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                True if it was, and so need not be handled again
+        """
+        if not redelivered and not properties.message_id:
+            return False
+
+        key = self.key(properties, body)
+        if key is None:
+            return False
+
+        with self.lock:
+            expiry = self.entries.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.time():
+                del self.entries[key]
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, messages):
+        """
+            Remembers the messages, (properties, body) tuples, as handled successfully
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        keys = [key for key in (self.key(properties, body) for properties, body in messages) if key is not None]
+        if not keys:
+            return
+
+        expiry = time.time() + self.ttl
+        with self.lock:
+            for key in keys:
+                self.entries[key] = expiry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+            due = self.path is not None and time.monotonic() - self.saved >= self.save_interval
+            if due:
+                self.saved = time.monotonic()
+
+        if due:
+            self.save()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """
+            Loads the messages saved by an earlier run, that have not yet expired.
+            A missing or damaged file is ignored
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        now = time.time()
+        try:
+            with open(self.path, 'r') as saved:
+                for line in saved:
+                    expiry, key = line.rstrip('\n').split(' ', 1)
+                    if float(expiry) > now:
+                        self.entries[key] = float(expiry)
+        except (OSError, ValueError):
+            pass
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """
+            Saves the messages to the file, replacing it in one step so that a
+            crash part way through leaves the previous file intact
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        if self.path is None:
+            return
+
+        with self.lock:
+            entries = list(self.entries.items())
+
+        with self.save_lock:
+            temp = self.path + '.tmp'
+            try:
+                with open(temp, 'w') as saved:
+                    saved.writelines('{0:.0f} {1}\n'.format(expiry, key)
+                                     for key, expiry in entries if '\n' not in key)
+                os.replace(temp, self.path)
+            except OSError:
+                #Only the ability to skip redeliveries after a restart is lost
+                pass
+
+
 class RabbitMessenger(ABC):
     """
         Communicates with a RabbitMQ service
@@ -63,6 +576,13 @@ class RabbitMessenger(ABC):
         self.connection = None
         self.channel = None
         self.cancel_on_close = True
+        self.confirm_window = 0
+        self.publish_seq = 0
+        self.unconfirmed = OrderedDict()
+        self.nacked = []
+        #Content encoding for published messages of at least compress_min bytes
+        self.compression = None
+        self.compress_min = 1024
 
     def __enter__(self):
         return self
@@ -71,7 +591,7 @@ class RabbitMessenger(ABC):
         self.stop()
 
     def establish_connection(self, parameters):
-        self.connection = pika.BlockingConnection(parameters)
+        self.connection = pika.BlockingConnection(parameters, _impl_class=SharedContextConnection)
         self.channel = self.connection.channel()
 
     def connect(self, connection_attempts, retry_delay):
@@ -89,21 +609,150 @@ class RabbitMessenger(ABC):
 
         if self.context.ssl is True:
             ssl_options['ssl_version'] = ssl.PROTOCOL_TLSv1_2
+            #The address is connected to, so name the host for SNI
+            ssl_options['server_hostname'] = self.context.host
         if self.context.cert is not None:
             ssl_options['ca_certs'] = self.context.cert
             ssl_options['cert_reqs'] = ssl.CERT_REQUIRED
 
         credentials = pika.PlainCredentials(self.context.user, self.context.pwd)
         parameters = pika.ConnectionParameters(
-                        self.context.host, self.context.port, self.context.vhost,
+                        resolve(self.context.host, self.context.port), self.context.port, self.context.vhost,
                         credentials, ssl=self.context.ssl, ssl_options=ssl_options,
                         connection_attempts=connection_attempts,
                         retry_delay=retry_delay)
-        self.establish_connection(parameters)
+        try:
+            self.establish_connection(parameters)
+        except Exception:
+            #The address may be stale, so resolve it again next time
+            forget(self.context.host, self.context.port)
+            raise
+
+    def is_open(self):
+        """
+            Checks that the connection and channel are still usable, handling any
+            pending events, so a connection closed by the broker is noticed
+
+            Throws:
+                Nothing
+
+            Returns:
+                True if the connection and channel are open
+        """
+        try:
+            if self.connection is None or self.channel is None:
+                return False
+            if self.connection.is_open and self.channel.is_open:
+                self.connection.process_data_events(time_limit=0)
+            return self.connection.is_open and self.channel.is_open
+        except Exception:
+            return False
+
+    def call_threadsafe(self, callback):
+        """
+            Requests that the callback is run on the thread that owns the connection,
+            since pika connections and channels are not thread safe
+
+            Throws:
+                Exception if the connection is closed
+
+            Returns:
+                None
+        """
+        self.connection.add_callback_threadsafe(callback)
+
+    def confirm_delivery(self, window=100):
+        """
+            Puts the channel in confirm mode, where the broker confirms each published
+            message. Up to window messages may be awaiting confirmation before
+            publish waits, see wait_for_confirms
+
+            Throws:
+                Exception if the broker does not support confirms
+
+            Returns:
+                None
+        """
+        #The blocking channel waits for each confirmation in turn, so confirms are
+        #tracked on the underlying asynchronous channel (pika 0.13) instead
+        self.channel._impl.confirm_delivery(self.on_confirm, nowait=True)
+        self.confirm_window = window
+        self.publish_seq = 0
+        self.unconfirmed.clear()
+        del self.nacked[:]
+
+    def on_confirm(self, method_frame):
+        """
+            Called by pika on the connection thread when the broker acks or nacks
+            one, or several, published messages
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        method = method_frame.method
+        if method.multiple:
+            tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            message = self.unconfirmed.pop(tag, None)
+            if isinstance(method, pika.spec.Basic.Nack):
+                self.nacked.append(message)
+
+    def wait_for_confirms(self, timeout=30, outstanding=0):
+        """
+            Waits until at most outstanding published messages are awaiting confirmation
+
+            Throws:
+                Exception if the messages are not confirmed within timeout seconds
+
+            Returns:
+                A list of the messages the broker rejected (nacked) since the last call
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.unconfirmed) > outstanding:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception("{0} published messages not confirmed".format(len(self.unconfirmed)))
+            self.connection.process_data_events(time_limit=remaining)
+
+        nacked = self.nacked
+        self.nacked = []
+        return nacked
+
+    def encode(self, message, properties=None):
+        """
+            Compresses a message body for publishing, when compression is enabled
+            and the body is at least compress_min bytes. The properties, by
+            default persistent delivery, are copied when the content encoding
+            is set, rather than changed
+
+            Throws:
+                ValueError if the compression is not supported
+
+            Returns:
+                The body, and the properties to publish it with
+        """
+        if properties is None:
+            properties = pika.BasicProperties(delivery_mode=2)
 
-    def publish(self, message, queue, exchange=''):
+        if self.compression is not None:
+            body = message.encode('utf-8') if isinstance(message, str) else message
+            if len(body) >= self.compress_min:
+                properties = copy.copy(properties)
+                properties.content_encoding = self.compression
+                return compress(body, self.compression), properties
+
+        return message, properties
+
+    def publish(self, message, queue, exchange='', properties=None):
         """
-            Publish a message to a queue
+            Publish a message to a queue. In confirm mode, waits first if the
+            window of messages awaiting confirmation is full
 
             Throws:
                 Exception - maybe access rights are insufficient on the queue
@@ -111,11 +760,84 @@ class RabbitMessenger(ABC):
             Returns:
                 None
         """
+        self.reserve_confirm()
+
+        body, properties = self.encode(message, properties)
         self.channel.basic_publish(
-            exchange=exchange, routing_key=queue, body=message,
-            properties=pika.BasicProperties(delivery_mode=2)
+            exchange=exchange, routing_key=queue, body=body,
+            properties=properties
         )
         self.outbound += 1
+        self.track_confirm(message)
+
+    def publish_many(self, messages, queue, exchange=''):
+        """
+            Publish many messages, each a body, a (routing_key, body) tuple or an
+            (exchange, routing_key, body) tuple, otherwise sent to queue via exchange.
+            The frames for all of the messages are written to the socket together
+
+            Throws:
+                Exception if the messages cannot be written to the socket
+
+            Returns:
+                A list of (index, exception) tuples for messages that could not be published
+        """
+        failures = []
+        #Shared by every message that is not compressed
+        properties = pika.BasicProperties(delivery_mode=2)
+
+        for index, message in enumerate(messages):
+            msg_exchange, routing_key, body = exchange, queue, message
+            if isinstance(message, tuple):
+                if len(message) == 3:
+                    msg_exchange, routing_key, body = message
+                else:
+                    routing_key, body = message
+
+            try:
+                self.reserve_confirm()
+
+                #Unlike the blocking channel, the underlying channel (pika 0.13)
+                #buffers the frames rather than writing them to the socket at once
+                self.channel._impl.basic_publish(msg_exchange, routing_key, *self.encode(body, properties))
+            except Exception as expt:
+                failures.append((index, expt))
+                continue
+
+            self.outbound += 1
+            self.track_confirm(body)
+
+        self.channel._flush_output()
+        return failures
+
+    def reserve_confirm(self):
+        """
+            In confirm mode, waits whilst the window of messages awaiting
+            confirmation is full
+
+            Throws:
+                Exception if the window does not open within the confirm timeout
+
+            Returns:
+                None
+        """
+        if self.confirm_window > 0 and len(self.unconfirmed) >= self.confirm_window:
+            self.nacked.extend(self.wait_for_confirms(outstanding=self.confirm_window - 1))
+
+    def track_confirm(self, message):
+        """
+            In confirm mode, records a published message as awaiting confirmation
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        if self.confirm_window > 0:
+            #The broker numbers confirms by the order messages were published
+            self.publish_seq += 1
+            self.unconfirmed[self.publish_seq] = message
 
     def stop(self):
         """
@@ -153,11 +875,20 @@ class RabbitClient(RabbitMessenger):
     def __init__(self, context, connection_attempts=10, retry_delay=1):
         super(RabbitClient, self).__init__(context)
         self.queue = None
+        self.pending = 0
+        self.subscriptions = []
+        self.dead_letter = None
+        #A RabbitCompleted, to ack redelivered messages without handling them again
+        self.completed = None
+        #Names of the queues declared on the channel
+        self.declared = set()
         self.connect(connection_attempts, retry_delay)
 
-    def start_queue(self, queue=None):
+    def start_queue(self, queue=None, prefetch=1):
         """
-            Declares (and creates) a queue, optionally removing any existing messages
+            Declares (and creates) a queue, optionally removing any existing messages.
+            prefetch is the number of unacknowledged messages the broker will
+            deliver to this consumer
 
             Throws:
                 Exception if queue cannot be created (access permissions)
@@ -174,23 +905,34 @@ class RabbitClient(RabbitMessenger):
                 queue=queue.name,
                 auto_delete=queue.auto_delete,
                 durable=queue.durable)
+            self.declared.add(queue.name)
 
-            #Ensure the consumer only gets 1 unacknowledged message
-            self.channel.basic_qos(prefetch_count=1)
+            #Limit the number of unacknowledged messages the consumer gets
+            self.channel.basic_qos(prefetch_count=prefetch)
 
             #Useful when testing - clear the queue
             if queue.purge is True:
                 self.channel.queue_purge(queue=queue.name)
 
 
-    def publish(self, message, queue=None, exchange=''):
+    def publish(self, message, queue=None, exchange='', properties=None):
         if queue is None:
             queue = self.queue
-        super(RabbitClient, self).publish(message, queue.name, exchange)
+        super(RabbitClient, self).publish(message, queue.name, exchange, properties)
 
-    def receive(self, handler, timeout=30, max_messages=0):
+    def publish_many(self, messages, queue=None, exchange=''):
+        if queue is None:
+            queue = self.queue
+        return super(RabbitClient, self).publish_many(messages, queue.name, exchange)
+
+    def receive(self, handler, timeout=30, max_messages=0, executor=None, partition=None):
         """
-            Start receiving messages, up to max_messages
+            Start receiving messages, up to max_messages.
+            If an executor is given, the handler is submitted to it for each message,
+            so up to the prefetch count of messages are handled concurrently and each
+            message is acked (or requeued) as soon as its handler completes.
+            With a partition function of the message properties and body, each
+            message is submitted to the (partitioned) executor with its key
 
             Throws:
                 Exception if consume fails
@@ -207,20 +949,893 @@ class RabbitClient(RabbitMessenger):
 
             method_frame, properties, body = msg
             if not method_frame:
+                #Keep waiting whilst handlers are still busy with messages
+                if self.pending > 0:
+                    continue
                 break
 
             msgs += 1
             self.inbound += 1
+            body = self.decoded(self.channel, self.queue.name, method_frame, properties, body)
 
-            #body is of type 'bytes' in Python 3+
-            state = handler(body)
-            if (state is None) or (state is True):
+            if body is None or self.duplicate(self.channel, method_frame, properties, body):
+                pass
+            elif executor is None:
+                #body is of type 'bytes' in Python 3+
+                state = handler(body)
                 #Only ack message if handler successfully dealt with message
                 #This could fail if the connection was closed by the broker
-                self.channel.basic_ack(method_frame.delivery_tag)
+                self.settle(self.channel, self.queue.name, method_frame.delivery_tag, False,
+                            state, [(properties, body)])
+            else:
+                if partition is not None:
+                    future = executor.submit_keyed(partition(properties, body), handler, body)
+                else:
+                    future = executor.submit(handler, body)
+                self.pending += 1
+                messages = [(properties, body)]
+                future.add_done_callback(functools.partial(
+                    self.handled, functools.partial(self.complete, method_frame.delivery_tag, messages), messages))
 
             #Stop consuming if message limit reached
             if msgs == max_messages:
                 break
 
+        #Wait for the outstanding handlers, so their messages are acked
+        while self.pending > 0:
+            self.connection.process_data_events(time_limit=1)
+
         return msgs
+
+    def drain(self):
+        """
+            Stops consuming, and may be called from any thread. Messages delivered
+            but not yet handled are returned to the queue, and receive (or
+            receive_batch) returns once the messages being handled are acked
+
+            Throws:
+                Exception if the connection is closed
+
+            Returns:
+                None
+        """
+        self.call_threadsafe(self.channel.cancel)
+
+    def depth(self, queue_name=None):
+        """
+            Counts the messages ready in a queue, and its consumers, without declaring it
+
+            Throws:
+                Exception if the queue does not exist, the channel is then closed
+
+            Returns:
+                A tuple of the message count and the consumer count
+        """
+        result = self.channel.queue_declare(queue=queue_name or self.queue.name, passive=True)
+        return result.method.message_count, result.method.consumer_count
+
+    def stream(self, timeout=None):
+        """
+            Consumes the queue, yielding a RabbitDelivery for each message, which
+            the caller must ack, nack or reject. The prefetch count of the queue
+            limits how many messages may be unacknowledged at once
+
+            Throws:
+                Exception if consume fails
+
+            Yields:
+                A RabbitDelivery for each message, until timeout seconds pass
+                without a message (never, if timeout is None)
+        """
+        for method_frame, properties, body in self.channel.consume(
+                self.queue.name,
+                exclusive=self.queue.exclusive,
+                inactivity_timeout=timeout):
+
+            if not method_frame:
+                break
+
+            self.inbound += 1
+            body = self.decoded(self.channel, self.queue.name, method_frame, properties, body)
+            if body is not None:
+                yield RabbitDelivery(self.channel, method_frame, properties, body)
+
+    def take(self, count, timeout=0):
+        """
+            Consumes up to count messages in one step, those the broker has already
+            delivered to this consumer, waiting up to timeout seconds if there
+            are none yet
+
+            Throws:
+                Exception if consume fails
+
+            Returns:
+                A list of RabbitDeliverys, empty if no message arrived in time
+        """
+        deliveries = []
+
+        for delivery in self.stream(timeout):
+            deliveries.append(delivery)
+
+            #Stop once the messages already buffered have been taken
+            if len(deliveries) >= count or self.channel.get_waiting_message_count() == 0:
+                break
+
+        return deliveries
+
+    def handled(self, complete, messages, future):
+        """
+            Called on an executor thread when a handler completes, passes the
+            outcome to complete, for the messages, on the connection thread
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                None
+        """
+        try:
+            state = future.result()
+        except Exception:
+            state = False
+
+        try:
+            self.call_threadsafe(functools.partial(complete, state))
+        except Exception:
+            #The connection has gone, the broker will redeliver the message,
+            #which is acked without being handled again if it succeeded
+            self.remember(state, messages)
+
+    def complete(self, delivery_tag, messages, state):
+        """
+            Settles a message handled on an executor. Must run on the connection thread
+
+            Throws:
+                Exception if the connection was closed by the broker
+
+            Returns:
+                None
+        """
+        self.pending -= 1
+        self.settle(self.channel, self.queue.name, delivery_tag, False, state, messages)
+
+    def decoded(self, channel, queue_name, method_frame, properties, body):
+        """
+            Decompresses a consumed message body, see decode. A body that cannot
+            be decompressed never will be, so the message is settled as a
+            permanent failure, keeping its content encoding
+
+            Throws:
+                Exception if the connection was closed by the broker
+
+            Returns:
+                The body, or None if the message was settled
+        """
+        try:
+            return decode(body, properties.content_encoding)
+        except Exception as expt:
+            LOGGER.error("Decode Exception: %s: %r", queue_name, expt)
+            self.settle(channel, queue_name, method_frame.delivery_tag, False,
+                        RabbitFailure(repr(expt), permanent=True, encoded=True), [(properties, body)])
+            return None
+
+    def duplicate(self, channel, method_frame, properties, body):
+        """
+            Acks a message without handling it, if it was handled successfully
+            before and is remembered by completed, see RabbitCompleted.seen
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                True if the message was a duplicate
+        """
+        if self.completed is None or not self.completed.seen(properties, body, method_frame.redelivered):
+            return False
+
+        channel.basic_ack(method_frame.delivery_tag)
+        return True
+
+    def remember(self, state, messages):
+        """Remembers the messages in completed, if their handler successfully dealt with them"""
+        if self.completed is not None and (state is None or state is True or isinstance(state, RabbitReply)):
+            self.completed.add(messages)
+
+    def settle(self, channel, queue_name, delivery_tag, multiple, state, messages):
+        """
+            Acks a message, or with multiple a batch, if its handler successfully
+            dealt with it, after publishing the replies if the handler returned a
+            RabbitReply. If the handler returned a RabbitFailure and there is a
+            dead letter policy, the messages, (properties, body) tuples, are
+            retried later or dead lettered, then acked (or returned to the queue
+            if the dead letter exchange has no queue for them). Without one, messages
+            that failed permanently are rejected, so the broker drops them (or
+            dead letters them, if the queue has a dead letter exchange of its
+            own). Otherwise the messages are returned to the queue
+
+            Throws:
+                Exception if the connection was closed by the broker
+
+            Returns:
+                None
+        """
+        self.remember(state, messages)
+
+        if (state is None) or (state is True):
+            channel.basic_ack(delivery_tag, multiple=multiple)
+        elif isinstance(state, RabbitReply):
+            self.reply(channel, state, messages)
+            channel.basic_ack(delivery_tag, multiple=multiple)
+        elif isinstance(state, RabbitFailure) and self.dead_letter is not None:
+            try:
+                for properties, body in messages:
+                    self.dead_letter.route(self.connection, queue_name, properties, body, state)
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as expt:
+                #Keep the messages on their queue until they can be dead lettered
+                LOGGER.error("Dead letter Exception: %s: %r", queue_name, expt)
+                channel.basic_nack(delivery_tag, multiple=multiple, requeue=True)
+                return
+            channel.basic_ack(delivery_tag, multiple=multiple)
+        elif isinstance(state, RabbitFailure) and state.permanent:
+            channel.basic_nack(delivery_tag, multiple=multiple, requeue=False)
+        else:
+            channel.basic_nack(delivery_tag, multiple=multiple, requeue=True)
+
+    def reply(self, channel, state, messages):
+        """
+            Publishes the replies of a RabbitReply, for the messages that have a
+            reply_to property, writing the frames for all of them together
+
+            Throws:
+                Exception if the replies cannot be written to the socket
+
+            Returns:
+                None
+        """
+        for (properties, _), reply in zip(messages, state.replies):
+            if not properties.reply_to:
+                continue
+
+            body, reply_properties = self.encode(reply, pika.BasicProperties(
+                correlation_id=properties.correlation_id, content_type=state.content_type))
+            #As publish_many, the underlying channel buffers the frames
+            channel._impl.basic_publish('', properties.reply_to, body, reply_properties)
+            self.outbound += 1
+
+        channel._flush_output()
+
+    def receive_batch(self, handler, batch_size, batch_bytes, batch_wait, timeout=30, measure=len):
+        """
+            Start receiving messages, handing them to the handler in batches.
+            A batch is complete once it holds batch_size messages or batch_bytes
+            bytes, each message counting for measure(body) bytes, or once
+            batch_wait seconds have passed since its first message.
+            The prefetch count of the queue should be at least batch_size
+
+            Throws:
+                Exception if consume fails
+
+            Returns:
+                The number of messages consumed
+        """
+        msgs = 0
+        batch = []
+        batch_size_bytes = 0
+        batch_start = last_msg = time.monotonic()
+
+        #Wake up regularly so a partial batch is not held longer than batch_wait
+        for msg in self.channel.consume(
+                self.queue.name,
+                exclusive=self.queue.exclusive,
+                inactivity_timeout=max(batch_wait, 0.01)):
+
+            method_frame, properties, body = msg
+            now = time.monotonic()
+
+            if method_frame:
+                body = self.decoded(self.channel, self.queue.name, method_frame, properties, body)
+                msgs += 1
+                self.inbound += 1
+                last_msg = now
+
+            if method_frame and body is not None and not self.duplicate(self.channel, method_frame, properties, body):
+                size = measure(body)
+
+                #Never let a batch grow beyond batch_bytes, send what we have first
+                if batch and batch_size_bytes + size > batch_bytes:
+                    self.complete_batch(handler, batch)
+                    batch = []
+                    batch_size_bytes = 0
+
+                if not batch:
+                    batch_start = now
+
+                batch.append((method_frame.delivery_tag, properties, body))
+                batch_size_bytes += size
+            elif not method_frame and not batch and now - last_msg >= timeout:
+                break
+
+            if batch and (len(batch) >= batch_size or
+                          batch_size_bytes >= batch_bytes or
+                          now - batch_start >= batch_wait):
+                self.complete_batch(handler, batch)
+                batch = []
+                batch_size_bytes = 0
+
+        #Consuming was cancelled, see drain
+        if batch:
+            self.complete_batch(handler, batch)
+
+        return msgs
+
+    def complete_batch(self, handler, batch):
+        """
+            Hands a batch of (delivery_tag, properties, body) tuples to the handler,
+            then acks or requeues the whole batch with a single frame
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                None
+        """
+        state = handler([body for _, _, body in batch])
+
+        #Every unacknowledged message on this channel belongs to the batch,
+        #so the last delivery tag covers all of them
+        self.settle(self.channel, self.queue.name, batch[-1][0], True, state,
+                    [(properties, body) for _, properties, body in batch])
+
+    def subscribe(self, queue, handler, prefetch=1, executor=None, exchange=None, binding_keys=(),
+                  batch_size=1, batch_bytes=0, batch_wait=0.1, partition=None, measure=len):
+        """
+            Consumes a queue on a channel of its own, so that several queues can
+            share this connection. With an exchange, the queue is bound to it with
+            each of the binding keys. Messages are handed to the handler, or in
+            batches of up to batch_size messages, whilst run is called.
+            partition is as for receive, and does not apply to batches.
+            measure is as for receive_batch
+
+            Throws:
+                Exception if the queue cannot be declared, bound or consumed
+
+            Returns:
+                The RabbitSubscription
+        """
+        channel = self.connection.channel()
+        channel.queue_declare(
+            queue=queue.name,
+            auto_delete=queue.auto_delete,
+            durable=queue.durable)
+
+        for binding_key in binding_keys:
+            channel.queue_bind(queue=queue.name, exchange=exchange, routing_key=binding_key)
+
+        #A batch is acked in one go, so only one batch may be in flight
+        channel.basic_qos(prefetch_count=batch_size if batch_size > 1 else prefetch)
+
+        subscription = RabbitSubscription(
+            self, channel, queue.name, handler, executor, batch_size, batch_bytes, batch_wait, partition, measure)
+        subscription.consumer_tag = channel.basic_consume(
+            subscription.on_message, queue.name, exclusive=queue.exclusive)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def run(self, running):
+        """
+            Handles messages for the subscriptions whilst running() is True
+
+            Throws:
+                Exception if the connection fails
+
+            Returns:
+                None
+        """
+        while running():
+            self.connection.process_data_events(time_limit=1)
+
+        #No more deliveries, those not yet handled are returned to the queue
+        for subscription in self.subscriptions:
+            subscription.cancel()
+
+        #Wait for the outstanding handlers, so their messages are acked
+        while any(subscription.pending > 0 or subscription.ready for subscription in self.subscriptions):
+            self.connection.process_data_events(time_limit=1)
+
+
+class RabbitSubscription():
+    """
+        A consumer on one channel of a shared connection. Its callbacks run on
+        the thread that owns the connection
+    """
+    def __init__(self, client, channel, queue_name, handler, executor=None, batch_size=1, batch_bytes=0,
+                 batch_wait=0.1, partition=None, measure=len):
+        self.client = client
+        self.channel = channel
+        self.queue_name = queue_name
+        self.handler = handler
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_wait = batch_wait
+        self.partition = partition
+        self.measure = measure
+        self.batch = []
+        self.batch_size_bytes = 0
+        self.timer = None
+        self.pending = 0
+        #Batches waiting for the batch in flight to be settled
+        self.ready = deque()
+        self.consumer_tag = None
+
+    def on_message(self, channel, method_frame, properties, body):
+        """
+            Called by pika for each message delivered to the channel
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                None
+        """
+        self.client.inbound += 1
+        body = self.client.decoded(channel, self.queue_name, method_frame, properties, body)
+
+        if body is None or self.client.duplicate(channel, method_frame, properties, body):
+            return
+
+        if self.batch_size <= 1:
+            key = self.partition(properties, body) if self.partition is not None else None
+            self.dispatch(method_frame.delivery_tag, body, False, [(properties, body)], key)
+            return
+
+        size = self.measure(body)
+
+        #Never let a batch grow beyond batch_bytes, send what we have first
+        if self.batch and self.batch_bytes > 0 and self.batch_size_bytes + size > self.batch_bytes:
+            self.flush()
+
+        if not self.batch:
+            #Send a partial batch once batch_wait has passed since its first message
+            self.timer = self.client.connection.add_timeout(self.batch_wait, self.flush)
+
+        self.batch.append((method_frame.delivery_tag, properties, body))
+        self.batch_size_bytes += size
+
+        if len(self.batch) >= self.batch_size or (self.batch_bytes > 0 and self.batch_size_bytes >= self.batch_bytes):
+            self.flush()
+
+    def cancel(self):
+        """
+            Stops consuming, handing any partial batch to the handler. Messages
+            delivered but not yet handed over are returned to the queue
+
+            Throws:
+                Exception if the connection was closed by the broker
+
+            Returns:
+                None
+        """
+        if self.consumer_tag is not None:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
+        self.flush()
+
+    def flush(self):
+        """
+            Hands the current batch to the handler, once the batch before it is settled
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                None
+        """
+        if self.timer is not None:
+            self.client.connection.remove_timeout(self.timer)
+            self.timer = None
+
+        if not self.batch:
+            return
+
+        self.ready.append(self.batch)
+        self.batch = []
+        self.batch_size_bytes = 0
+        self.dispatch_ready()
+
+    def dispatch_ready(self):
+        """
+            Hands the ready batches to the handler in turn, one at a time, so a
+            batch is acked (or requeued) in one go without touching the next
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                None
+        """
+        while self.pending == 0 and self.ready:
+            batch = self.ready.popleft()
+
+            #Every unacknowledged message on this channel up to the last delivery
+            #tag of the batch belongs to it, so that tag covers all of them
+            self.dispatch(batch[-1][0], [body for _, _, body in batch], True,
+                          [(properties, body) for _, properties, body in batch])
+
+    def dispatch(self, delivery_tag, body, multiple, messages, key=None):
+        """
+            Runs the handler, on the executor if there is one, keyed by the
+            partition key of the message when partitioning
+
+            Throws:
+                Exception if the ack fails (the connection was closed by the broker)
+
+            Returns:
+                None
+        """
+        if self.executor is None:
+            self.complete(delivery_tag, multiple, messages, self.handler(body))
+        else:
+            if self.partition is not None and not multiple:
+                future = self.executor.submit_keyed(key, self.handler, body)
+            else:
+                future = self.executor.submit(self.handler, body)
+            self.pending += 1
+            future.add_done_callback(functools.partial(
+                self.client.handled, functools.partial(self.settle, delivery_tag, multiple, messages), messages))
+
+    def settle(self, delivery_tag, multiple, messages, state):
+        """Completes a message handled on the executor, on the connection thread"""
+        self.pending -= 1
+        self.complete(delivery_tag, multiple, messages, state)
+        if multiple:
+            self.dispatch_ready()
+
+    def complete(self, delivery_tag, multiple, messages, state):
+        """
+            Acks a message (or batch) if its handler successfully dealt with it,
+            otherwise retries, dead letters, rejects or requeues it, see RabbitClient.settle
+
+            Throws:
+                Exception if the connection was closed by the broker
+
+            Returns:
+                None
+        """
+        self.client.settle(self.channel, self.queue_name, delivery_tag, multiple, state, messages)
+
+
+class RabbitStandby():
+    """
+        Keeps a connected client in reserve, so that a consumer whose connection
+        fails can carry on without waiting for a new connection to be established
+    """
+    def __init__(self, context, factory=None, interval=5):
+        self.context = context
+        self.factory = factory or RabbitClient
+        self.interval = interval
+        self.client = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='standby', daemon=True)
+        self.thread.start()
+
+    def take(self):
+        """
+            Hands over the standby client, a replacement is then connected in the background
+
+            Throws:
+                Nothing
+
+            Returns:
+                A connected client, or None if there is no healthy standby
+        """
+        with self.lock:
+            client, self.client = self.client, None
+        self.wake.set()
+
+        #The client now belongs to the calling thread
+        if client is not None and not client.is_open():
+            client.stop()
+            client = None
+        return client
+
+    def run(self):
+        """
+            A thread, that keeps a standby client connected, servicing its heartbeats
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        failures = 0
+        while not self.stopped.is_set():
+            with self.lock:
+                if self.client is not None and not self.client.is_open():
+                    self.client.stop()
+                    self.client = None
+                connected = self.client is not None
+
+            delay = self.interval
+            if not connected:
+                try:
+                    client = self.factory(self.context)
+                    with self.lock:
+                        self.client = client
+                    failures = 0
+                except Exception:
+                    #The service may be unavailable, back off (with jitter)
+                    delay = random.uniform(0, min(self.interval * 6, 0.5 * (2 ** failures)))
+                    failures += 1
+
+            self.wake.wait(delay)
+            self.wake.clear()
+
+    def stop(self):
+        """
+            Stops keeping a standby client, closing it
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        self.stopped.set()
+        self.wake.set()
+        with self.lock:
+            client, self.client = self.client, None
+        if client is not None:
+            client.stop()
+
+
+class RabbitPool():
+    """
+        Keeps up to max_connections connected clients for a RabbitMQ service, handing
+        them out with checkout and taking them back with checkin, so that many short
+        lived publishers and consumers share a few connections. pika connections are
+        not thread safe, so a client (its connection and channel) is checked out to
+        one thread at a time. Clients idle for max_idle seconds, or connected for
+        max_lifetime seconds, are closed; with an interval, idle clients are checked
+        (and their heartbeats serviced) in the background every interval seconds
+    """
+    def __init__(self, context, max_connections=4, max_idle=300, max_lifetime=3600, factory=None, interval=0):
+        self.context = context
+        self.max_connections = max(max_connections, 1)
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.factory = factory or functools.partial(RabbitClient, connection_attempts=1)
+        #(client, checked in at) tuples, the most recently used last
+        self.idle = deque()
+        self.connected_at = {}
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        #Counts, for metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.evicted = 0
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.run, args=(interval,), name='pool', daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def expired(self, client, checked_in, now):
+        """Whether an idle client has been idle, or connected, for too long"""
+        return now - checked_in > self.max_idle or now - self.connected_at[client] > self.max_lifetime
+
+    def discard(self, client):
+        """
+            Closes a client, making room for another
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        with self.condition:
+            self.connected_at.pop(client, None)
+            self.size -= 1
+            self.evicted += 1
+            self.condition.notify()
+        client.stop()
+
+    def checkout(self, timeout=30):
+        """
+            Hands out an idle client that is still healthy, connecting a new one
+            if there is room, otherwise waiting up to timeout seconds for a checkin
+
+            Throws:
+                TimeoutError if no client could be handed out within timeout,
+                otherwise an exception if a new connection is not successful
+
+            Returns:
+                A RabbitClient, which must be checked in again
+        """
+        start = time.monotonic()
+        waited = False
+
+        while True:
+            client = None
+            with self.condition:
+                if self.closed:
+                    raise Exception("The pool is closed")
+                if self.idle:
+                    client, checked_in = self.idle.pop()
+                elif self.size < self.max_connections:
+                    self.size += 1
+                else:
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise TimeoutError("No RabbitMQ connection free within {0}s".format(timeout))
+                    waited = True
+                    self.condition.wait(remaining)
+                    continue
+
+            if client is None:
+                try:
+                    client = self.factory(self.context)
+                except Exception:
+                    with self.condition:
+                        self.size -= 1
+                        self.condition.notify()
+                    raise
+                with self.condition:
+                    self.connected_at[client] = time.monotonic()
+                    self.created += 1
+            elif self.expired(client, checked_in, time.monotonic()) or not client.is_open():
+                self.discard(client)
+                continue
+
+            with self.condition:
+                self.checkouts += 1
+                if waited:
+                    self.waits += 1
+                    self.wait_seconds += time.monotonic() - start
+            return client
+
+    def checkin(self, client, discard=False):
+        """
+            Takes back a client, keeping it for the next checkout unless it is
+            broken, too old, or discard is set (after it failed, say). Any consumer
+            left on its channel is cancelled, returning its messages to the queue
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        now = time.monotonic()
+        if not discard:
+            try:
+                #Channels opened by subscribe are not kept
+                discard = bool(client.subscriptions) or now - self.connected_at[client] > self.max_lifetime
+                if not discard:
+                    client.channel.cancel()
+                    discard = not client.is_open()
+            except Exception:
+                discard = True
+
+        with self.condition:
+            if not discard and not self.closed:
+                self.idle.append((client, now))
+                self.condition.notify()
+                return
+        self.discard(client)
+
+    @contextmanager
+    def client(self, timeout=30):
+        """
+            Checks out a client for the duration of a with block, checking it in
+            again afterwards, or discarding it if the block raised an exception
+
+            Throws:
+                As checkout, and any exception raised in the block
+
+            Returns:
+                A RabbitClient
+        """
+        client = self.checkout(timeout)
+        try:
+            yield client
+        except BaseException:
+            self.checkin(client, discard=True)
+            raise
+        self.checkin(client)
+
+    def evict(self):
+        """
+            Closes the idle clients that are expired or broken, servicing the
+            heartbeats of the rest
+
+            Throws:
+                Nothing
+
+            Returns:
+                The number of clients closed
+        """
+        with self.condition:
+            idle = list(self.idle)
+            self.idle.clear()
+
+        kept = []
+        evicted = 0
+        now = time.monotonic()
+        for client, checked_in in idle:
+            if self.expired(client, checked_in, now) or not client.is_open():
+                self.discard(client)
+                evicted += 1
+            else:
+                kept.append((client, checked_in))
+
+        with self.condition:
+            #Clients checked in meanwhile are the most recently used
+            self.idle.extendleft(reversed(kept))
+            self.condition.notify_all()
+        return evicted
+
+    def stats(self):
+        """
+            The state of the pool, and counts of checkouts, waits and connections
+
+            Throws:
+                Nothing
+
+            Returns:
+                A dict
+        """
+        with self.condition:
+            return {
+                'connections': self.size, 'idle': len(self.idle), 'checkouts': self.checkouts,
+                'waits': self.waits, 'wait_seconds': self.wait_seconds, 'timeouts': self.timeouts,
+                'created': self.created, 'evicted': self.evicted}
+
+    def run(self, interval):
+        """
+            A thread, that evicts idle clients every interval seconds until the pool is closed
+
+            Throws:
+                No exceptions thrown
+
+            Returns:
+                Nothing
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, interval)
+                if self.closed:
+                    return
+            self.evict()
+
+    def close(self):
+        """
+            Closes the idle clients, those checked out are closed when checked in
+
+            Throws:
+                Nothing
+
+            Returns:
+                None
+        """
+        with self.condition:
+            self.closed = True
+            idle = [client for client, _ in self.idle]
+            self.idle.clear()
+            self.condition.notify_all()
+        for client in idle:
+            self.discard(client)
@@ -6,5 +6,29 @@ source env.sh
 #Can increase the number of "listeners" to RabbitMQ if necessary
 #export RABBIT_CONNECTIONS=4
 
+#Can grow and shrink the number of "listeners" with the depth of the queue
+#export AUTOSCALE_MIN=1
+#export AUTOSCALE_MAX=16
+
+#Can handle several messages at once on each connection if necessary
+#export RABBIT_PREFETCH=8
+
+#Can invoke messages in parallel whilst keeping the order of those with the same key
+#export PARTITION_KEY=header:device_id
+
+#Can send several messages to the action in one invocation if necessary
+#export WHISK_BATCH_SIZE=100
+
+#Can ack redelivered messages without invoking the action again, if they were handled recently
+#export IDEMPOTENCY_SIZE=100000
+
+#Can log a summary every few seconds, and only a sample of the invocations, at high message rates
+#export LOG_ASYNC=true
+#export LOG_SUMMARY=10
+#export LOG_SAMPLE=0.01
+
+#Can consume several queues, each invoking its own action, in place of FEED_QUEUE and WHISK_ACTION
+#export ROUTES='[{"queue": "orders", "action": "ProcessOrder"}, {"queue": "audit", "action": "Audit"}]'
+
 #Start the RabbitMQ listener container
-docker run -d --rm --name rabbitmq_feed -e RABBIT_BROKER="$RABBIT_BROKER" -e RABBIT_PORT="$RABBIT_PORT" -e RABBIT_VHOST="$RABBIT_VHOST" -e RABBIT_USER="$RABBIT_USER" -e RABBIT_PWD="$RABBIT_PWD" -e RABBIT_CONNECTIONS="$RABBIT_CONNECTIONS" -e FEED_QUEUE="$FEED_QUEUE" -e WHISK_SPACE="$WHISK_SPACE" -e WHISK_AUTH="$WHISK_AUTH" -e WHISK_URL="$WHISK_URL" -e WHISK_ACTION="$WHISK_ACTION" rabbitmq_feed
+docker run -d --rm --name rabbitmq_feed -e RABBIT_BROKER="$RABBIT_BROKER" -e RABBIT_PORT="$RABBIT_PORT" -e RABBIT_VHOST="$RABBIT_VHOST" -e RABBIT_USER="$RABBIT_USER" -e RABBIT_PWD="$RABBIT_PWD" -e RABBIT_CONNECTIONS="$RABBIT_CONNECTIONS" -e RABBIT_PROCESSES="$RABBIT_PROCESSES" -e RABBIT_PREFETCH="$RABBIT_PREFETCH" -e RABBIT_STANDBY="$RABBIT_STANDBY" -e AUTOSCALE_MIN="$AUTOSCALE_MIN" -e AUTOSCALE_MAX="$AUTOSCALE_MAX" -e AUTOSCALE_INTERVAL="$AUTOSCALE_INTERVAL" -e AUTOSCALE_TARGET="$AUTOSCALE_TARGET" -e WHISK_WORKERS="$WHISK_WORKERS" -e WORK_QUEUE_SIZE="$WORK_QUEUE_SIZE" -e PARTITION_KEY="$PARTITION_KEY" -e SPILL_DIR="$SPILL_DIR" -e SPILL_MAX_MB="$SPILL_MAX_MB" -e SPILL_SEGMENT_MB="$SPILL_SEGMENT_MB" -e SPILL_REPLAY_RATE="$SPILL_REPLAY_RATE" -e METRICS_PORT="$METRICS_PORT" -e INVOKER_ENGINE="$INVOKER_ENGINE" -e ASYNC_CONCURRENCY="$ASYNC_CONCURRENCY" -e FEED_QUEUE="$FEED_QUEUE" -e WHISK_SPACE="$WHISK_SPACE" -e WHISK_AUTH="$WHISK_AUTH" -e WHISK_URL="$WHISK_URL" -e WHISK_ACTION="$WHISK_ACTION" -e DEAD_LETTER_EXCHANGE="$DEAD_LETTER_EXCHANGE" -e RETRY_DELAY="$RETRY_DELAY" -e RETRY_DELAY_MAX="$RETRY_DELAY_MAX" -e WHISK_MAX_INFLIGHT="$WHISK_MAX_INFLIGHT" -e WHISK_BACKOFF="$WHISK_BACKOFF" -e WHISK_BACKOFF_MAX="$WHISK_BACKOFF_MAX" -e WHISK_PAYLOAD="$WHISK_PAYLOAD" -e WHISK_BATCH_SIZE="$WHISK_BATCH_SIZE" -e WHISK_BATCH_BYTES="$WHISK_BATCH_BYTES" -e WHISK_BATCH_WAIT="$WHISK_BATCH_WAIT" -e WHISK_ENCODING="$WHISK_ENCODING" -e WHISK_RPC="$WHISK_RPC" -e IDEMPOTENCY_SIZE="$IDEMPOTENCY_SIZE" -e IDEMPOTENCY_TTL="$IDEMPOTENCY_TTL" -e IDEMPOTENCY_KEY="$IDEMPOTENCY_KEY" -e IDEMPOTENCY_FILE="$IDEMPOTENCY_FILE" -e LOG_ASYNC="$LOG_ASYNC" -e LOG_QUEUE_SIZE="$LOG_QUEUE_SIZE" -e LOG_SUMMARY="$LOG_SUMMARY" -e LOG_SAMPLE="$LOG_SAMPLE" -e LOG_RATE="$LOG_RATE" -e ROUTES="$ROUTES" rabbitmq_feed
@@ -0,0 +1,9 @@
+#!/bin/bash
+#Author: Mark Purcell (markpurcell@ie.ibm.com)
+
+#Run the offline listener start up benchmark, no RabbitMQ service or Cloud Functions needed
+#For example: ./startup_benchmark.sh --connections 1,4,16 --connect-ms 100 --cert $PWD/cert.pem
+cd invoker
+ln -s ../messenger
+python3 startup_benchmark.py "$@"
+rm messenger